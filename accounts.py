@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# ~/bin/accounts.py
+# Train and file many accounts in one process, from ~/.imap-accounts.yaml:
+#
+#   max_connections: 4            # IMAP connections open at once per server
+#   servers:
+#     imap.example.net: { max_connections: 2 }
+#   defaults:
+#     imap_host: imap.mailbox.org
+#     smtp_host: smtp.mailbox.org
+#   accounts:
+#     - name: personal
+#       imap_user: me@example.org
+#       imap_pass_env: PERSONAL_IMAP_PASS   # or imap_pass: ...
+#       mailboxes: [INBOX, Lists]           # default [INBOX]
+#     - name: work
+#       imap_host: imap.example.net         # also imap_port, smtp_host/port/user/pass(_env)
+#       imap_user: me@example.com
+#       imap_pass_env: WORK_IMAP_PASS
+#       train:                              # default: train_rules.TRAIN_MAP; false = no training
+#         Train/Vendors: [mark_read, { move: Vendors }]
+#
+# Each account keeps its own rules, checkpoint, header cache and forward spool
+# under ~/.imap-accounts/<name>/. Accounts run concurrently; per account the
+# trainer runs first, then the filer, over one IMAP connection.
+import argparse, asyncio, logging, os, sys, time
+import yaml
+import filer, logsetup, metrics, train_rules
+from asyncmail import Account, ConnectionLimit
+from mailio import capabilities, parse_action
+from rulestore import YAML_LOADER
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = "~/.imap-accounts.log"
+
+ACCOUNTS_FILE = os.path.expanduser(os.getenv("ACCOUNTS_FILE", "~/.imap-accounts.yaml"))
+ACCOUNTS_DIR = os.path.expanduser(os.getenv("ACCOUNTS_DIR", "~/.imap-accounts"))
+
+# As FILER_METRICS / FILER_PROFILE, for the whole multi-account run
+METRICS_FILE = os.path.expanduser(os.getenv("ACCOUNTS_METRICS", "~/.imap-accounts-metrics.json"))
+PROFILE_FILE = os.path.expanduser(os.getenv("ACCOUNTS_PROFILE", ""))
+
+MAX_CONNECTIONS = 4
+
+class ConfigError(Exception):
+    pass
+
+def secret(entry, key):
+    if entry.get(key):
+        return entry[key]
+    env = entry.get(f"{key}_env")
+    if env:
+        if not os.getenv(env):
+            raise ConfigError(f"{entry.get('name')}: environment variable {env} is not set")
+        return os.getenv(env)
+    return None
+
+def train_map(value):
+    if value is None or value is True:
+        return train_rules.TRAIN_MAP
+    if not value:
+        return {}
+    # rule-style actions ("mark_read", {"move": "X"}) -> trainer tuples
+    return {folder: [parse_action(a) for a in actions] for folder, actions in value.items()}
+
+def load_accounts(path=ACCOUNTS_FILE):
+    """Return [(account, mailboxes, train map), ...] from the config file."""
+    with open(path) as f:
+        config = yaml.load(f, Loader=YAML_LOADER) or {}
+    defaults = config.get("defaults") or {}
+    servers = config.get("servers") or {}
+    limits = {}
+    out, names = [], set()
+    for entry in config.get("accounts") or []:
+        entry = {**defaults, **entry}
+        name = str(entry.get("name") or "")
+        if not name or "/" in name or name.startswith("."):
+            raise ConfigError(f"account needs a plain name: {entry.get('name')!r}")
+        if name in names:
+            raise ConfigError(f"duplicate account name {name!r}")
+        names.add(name)
+        host = entry.get("imap_host", filer.IMAP_HOST)
+        user, password = entry.get("imap_user"), secret(entry, "imap_pass")
+        if not (user and password):
+            raise ConfigError(f"{name}: set imap_user and imap_pass (or imap_pass_env)")
+        port = entry.get("imap_port")
+        if (host, port) not in limits:
+            size = (servers.get(host) or {}).get("max_connections", config.get("max_connections", MAX_CONNECTIONS))
+            limits[host, port] = ConnectionLimit(max(1, int(size)))
+        home = os.path.expanduser(entry.get("dir") or os.path.join(ACCOUNTS_DIR, name))
+        os.makedirs(home, exist_ok=True)
+        account = Account(
+            name, host, user, password,
+            entry.get("smtp_host", filer.SMTP_HOST), entry.get("smtp_user", user),
+            secret(entry, "smtp_pass") or password,
+            os.path.join(home, "spool"), os.path.join(home, "rules.yaml"), os.path.join(home, "rules.db"),
+            os.path.join(home, "state.json"), os.path.join(home, "header-cache.db"), limits[host, port],
+            port, entry.get("smtp_port"))
+        out.append((account, entry.get("mailboxes") or ["INBOX"], train_map(entry.get("train"))))
+    return out
+
+async def run_account(account, mailboxes, train, do_train=True, do_file=True):
+    """Train, then file, one account; returns (trained, matched)."""
+    trained = matched = 0
+    aimap = await account.connect()  # waits for a free slot on the server
+    smtp = account.smtp()
+    try:
+        caps = await aimap.call(capabilities)
+        if do_train and train:
+            trained = await train_rules.train_account(account, aimap, smtp, caps, train)
+        if do_file:
+            rules = await asyncio.to_thread(filer.load_rules, account)
+            if rules:
+                matched = await filer.file_account(account, aimap, smtp, caps, rules, mailboxes)
+        with metrics.span("forward_drain"):
+            await smtp.drain()
+    finally:
+        await aimap.logout()
+    return trained, matched
+
+async def run_all(accounts, do_train=True, do_file=True):
+    """Run every account concurrently; returns the names of those that failed."""
+    async def one(account, mailboxes, train):
+        try:
+            return await run_account(account, mailboxes, train, do_train, do_file)
+        except Exception as e:
+            logger.exception("%s: failed: %s", account.name, e)
+            return None
+
+    started = time.time()
+    results = await asyncio.gather(*(one(*a) for a in accounts))
+    failed = [a[0].name for a, r in zip(accounts, results) if r is None]
+    done = [r for r in results if r is not None]
+    logger.info("%d accounts: trained on %d messages, %d matched, %d failed%s in %.2fs",
+                len(accounts), sum(t for t, _ in done), sum(m for _, m in done), len(failed),
+                f" ({', '.join(failed)})" if failed else "", time.time() - started)
+    metrics.current.write(METRICS_FILE)
+    return failed
+
+def main():
+    ap = argparse.ArgumentParser(description="Train and file several IMAP accounts in one process")
+    ap.add_argument("--config", default=ACCOUNTS_FILE, help="accounts file (default: %(default)s)")
+    ap.add_argument("--only", action="append", metavar="NAME", help="run just this account (repeatable)")
+    mode = ap.add_mutually_exclusive_group()
+    mode.add_argument("--no-train", action="store_true", help="only file (e.g. from a frequent timer)")
+    mode.add_argument("--no-file", action="store_true", help="only train")
+    args = ap.parse_args()
+
+    logsetup.setup(LOG_FILE)
+    metrics.start("accounts")
+    try:
+        accounts = load_accounts(args.config)
+    except (OSError, yaml.YAMLError, ConfigError) as e:
+        logger.error("Configuration error: %s", e)
+        return 2
+    if args.only:
+        accounts = [a for a in accounts if a[0].name in args.only]
+    if not accounts:
+        logger.error("No accounts to run in %s", args.config)
+        return 2
+    with metrics.profile(PROFILE_FILE):
+        failed = asyncio.run(run_all(accounts, not args.no_train, not args.no_file))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,390 @@
+# ~/bin/asyncmail.py
+# asyncio front end for IMAP and SMTP shared by filer.py and train_rules.py.
+#
+# imaplib and smtplib are blocking, so each command runs in a worker thread
+# (asyncio.to_thread). One connection still runs one command at a time, but
+# separate connections, the SMTP session and the matcher overlap: the next
+# FETCH chunk downloads while the current one is matched, and forwards go
+# out while filing continues.
+import asyncio, email, email.policy, glob, itertools, logging, os, smtplib, tempfile, time
+import metrics
+from email.message import EmailMessage
+import mailio
+from headercache import header_block, parse_many
+
+logger = logging.getLogger(__name__)
+
+# SMTP_SSL=0 speaks plain SMTP (local test servers such as bench/fakesmtp.py)
+SMTP_SSL = os.getenv("SMTP_SSL", "1") != "0"
+SMTP_PORT = int(os.getenv("SMTP_PORT", "465" if SMTP_SSL else "25"))
+
+# SMTP sessions sending forwards in parallel; each stays logged in for the run
+SMTP_SESSIONS = int(os.getenv("SMTP_SESSIONS", "1"))
+
+# Attempts after the first for a forward that failed with a transient error,
+# waiting RETRY_DELAY, 2 * RETRY_DELAY, ... (capped) in between
+SEND_RETRIES = int(os.getenv("SMTP_RETRIES", "3"))
+RETRY_DELAY = 2
+MAX_RETRY_DELAY = 60
+
+# FETCH chunks downloaded ahead of the matcher
+PREFETCH_CHUNKS = 2
+
+# Messages per task when fetched chunks are parsed in a process pool
+PARSE_BATCH = 100
+
+class ConnectionLimit(asyncio.Semaphore):
+    """The IMAP connections that may be open to one server at once.
+
+    AsyncIMAP.connect() waits for a slot. reserve() only takes slots that are
+    free right now, for extra fetch workers, so an account holding one
+    connection never waits on another that is doing the same.
+    """
+
+    async def reserve(self, n):
+        taken = 0
+        # acquire() does not suspend while the semaphore is unlocked
+        while taken < n and not self.locked():
+            await self.acquire()
+            taken += 1
+        return taken
+
+    def release_many(self, n):
+        for _ in range(n):
+            self.release()
+
+class AsyncIMAP:
+    """An imaplib connection driven from asyncio."""
+
+    def __init__(self, imap, limit=None):
+        self.imap = imap
+        self._lock = asyncio.Lock()
+        self._limit = limit
+
+    @classmethod
+    async def connect(cls, host, user, password, limit=None, port=None):
+        """Log in; with a ConnectionLimit, first wait for a free slot (freed by logout())."""
+        if limit is not None:
+            await limit.acquire()
+        try:
+            return cls(await asyncio.to_thread(mailio.connect, host, user, password, port), limit)
+        except BaseException:
+            if limit is not None:
+                limit.release()
+            raise
+
+    async def call(self, fn, *args, **kwargs):
+        """Run fn(imap, *args, **kwargs) in a thread, one call at a time."""
+        async with self._lock:
+            return await asyncio.to_thread(fn, self.imap, *args, **kwargs)
+
+    async def uid(self, *args):
+        return await self.call(lambda imap: imap.uid(*args))
+
+    async def fetch(self, uids, spec, chunk=None, pool=None):
+        """Async version of mailio.fetch_batched() that prefetches chunks.
+
+        At most PREFETCH_CHUNKS chunks are buffered, so memory stays bounded
+        by the chunk size however far the producer runs ahead. With pool (a
+        process pool), each record also gets rec["parsed"], the
+        headercache.parse_features() of its data, worked out in the pool
+        while later chunks are still downloading; records still come out in
+        UID order.
+        """
+        chunk = chunk or mailio.FETCH_CHUNK
+        queue = asyncio.Queue(PREFETCH_CHUNKS)
+
+        async def produce():
+            loop = asyncio.get_running_loop()
+            try:
+                for part in mailio.chunks(list(uids), chunk):
+                    recs = await self.call(lambda imap: list(mailio.fetch_batched(imap, part, spec, chunk)))
+                    parsed = None
+                    if pool is not None:
+                        # only the headers are pickled over to the workers
+                        parsed = [loop.run_in_executor(
+                                      pool, parse_many,
+                                      [None if rec["data"] is None else header_block(rec["data"]) for rec in batch])
+                                  for batch in mailio.chunks(recs, PARSE_BATCH)]
+                    await queue.put((recs, parsed))
+            finally:
+                await queue.put(None)
+
+        producer = asyncio.create_task(produce())
+        try:
+            while (item := await queue.get()) is not None:
+                recs, parsed = item
+                if parsed is not None:
+                    for batch, results in zip(mailio.chunks(recs, PARSE_BATCH), parsed):
+                        for rec, result in zip(batch, await results):
+                            rec["parsed"] = result
+                for rec in recs:
+                    yield rec
+            await producer  # surface FETCH errors
+        finally:
+            producer.cancel()
+
+    async def logout(self):
+        try:
+            await self.call(lambda imap: imap.logout())
+        except Exception:
+            pass
+        finally:
+            if self._limit is not None:
+                self._limit.release()
+                self._limit = None
+
+async def fetch_sharded(connect, mailbox, uids, spec, handle, workers=None, pool=None):
+    """Fetch and process uids over several read-only connections at once.
+
+    The UIDs are split into contiguous ranges, one per worker. Each worker
+    opens its own connection with `await connect()`, EXAMINEs mailbox,
+    streams its range (parsed in pool, see AsyncIMAP.fetch) and calls
+    handle(rec). Results that are not None are returned merged in UID order,
+    so the caller can apply them on its own read-write connection exactly
+    as the sequential path would.
+
+    Every connection is opened before any UID is fetched. If one cannot log
+    in or EXAMINE (servers often cap connections per user), the others are
+    closed and None is returned, and the caller fetches on its own
+    connection instead. A worker that fails mid-fetch cancels the rest.
+    """
+    uids = sorted(uids, key=int)
+    workers = max(1, min(workers or mailio.WORKERS, len(uids)))
+    size = -(-len(uids) // workers) if uids else 1
+    shards = [uids[i:i + size] for i in range(0, len(uids), size)]
+
+    async def open_worker():
+        aimap = await connect()
+        try:
+            if await aimap.call(mailio.select_mailbox, mailbox, readonly=True) is None:
+                raise RuntimeError(f"worker could not examine {mailbox}")
+        except BaseException:
+            await aimap.logout()
+            raise
+        return aimap
+
+    async def work(aimap, shard):
+        out = []
+        async for rec in aimap.fetch(shard, spec, pool=pool):
+            result = handle(rec)
+            if result is not None:
+                out.append((int(rec["uid"]), result))
+        logger.debug("Worker finished UIDs %s-%s: %d results", int(shard[0]), int(shard[-1]), len(out))
+        return out
+
+    opened = await asyncio.gather(*(open_worker() for _ in shards), return_exceptions=True)
+    conns = [c for c in opened if isinstance(c, AsyncIMAP)]
+    try:
+        errors = [e for e in opened if not isinstance(e, AsyncIMAP)]
+        for e in errors:
+            if not isinstance(e, Exception):
+                raise e  # cancelled: not a reason to fall back
+        if errors:
+            logger.warning("Could not open %d of %d fetch connections (%s); fetching over one",
+                           len(errors), len(shards), errors[0])
+            return None
+        tasks = [asyncio.create_task(work(aimap, shard)) for aimap, shard in zip(conns, shards)]
+        try:
+            parts = await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        await asyncio.gather(*(aimap.logout() for aimap in conns))
+    merged = sorted((r for part in parts for r in part), key=lambda r: r[0])
+    return [result for _, result in merged]
+
+def build_forward(raw_bytes, from_addr, to_addr):
+    # Minimal forward as message/rfc822 attachment (works with TripIt)
+    msg = EmailMessage()
+    msg["From"] = from_addr
+    msg["To"] = to_addr
+    msg["Subject"] = "Fwd: travel docs"
+    msg.set_content("Forwarded itinerary/booking.")
+    msg.add_attachment(raw_bytes, maintype="message", subtype="rfc822", filename="message.eml")
+    return msg
+
+def is_permanent(error):
+    """True for SMTP errors that retrying the same message will not fix."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # raised whenever every recipient is refused, 4xx (try later) included
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return (isinstance(error, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError))
+            and error.smtp_code >= 500)
+
+class AsyncSMTP:
+    """Sends forwards in the background over reused SMTP sessions.
+
+    forward() writes the message to the spool directory and returns. Up to
+    SMTP_SESSIONS workers send spooled messages back to back, each over one
+    session that stays logged in until drain(). A message leaves the spool
+    only once the server has accepted it, so forwards cut short by a crash or
+    an outage go out on the next run. Transient failures are retried with
+    backoff; messages the server rejects outright move to spool/failed.
+    """
+
+    def __init__(self, host, user, password, spool, port=None, sessions=None):
+        self.host, self.user, self.password, self.port = host, user, password, port or SMTP_PORT
+        self.spool = spool
+        self.sessions = sessions or SMTP_SESSIONS
+        self._seq = itertools.count()
+        self._queue = None
+        self._workers = []
+        self._down = False
+        self._sent = 0
+
+    def _start(self):
+        if self._queue is not None:
+            return
+        self._queue = asyncio.Queue()
+        self._down = False
+        # anything still spooled was not delivered by an earlier run
+        leftover = sorted(glob.glob(os.path.join(self.spool, "*.eml")))
+        if leftover:
+            logger.info("Resending %d spooled forwards", len(leftover))
+        for path in leftover:
+            self._queue.put_nowait(path)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.sessions)]
+
+    def _write_spool(self, msg):
+        os.makedirs(self.spool, exist_ok=True)
+        path = os.path.join(self.spool, f"{time.time_ns()}-{next(self._seq)}.eml")
+        fd, tmp = tempfile.mkstemp(dir=self.spool, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(msg.as_bytes())
+        os.replace(tmp, path)
+        return path
+
+    def _open(self):
+        session = (smtplib.SMTP_SSL if SMTP_SSL else smtplib.SMTP)(self.host, self.port)
+        session.login(self.user, self.password)
+        metrics.count("smtp_logins")
+        return session
+
+    @staticmethod
+    def _close(session):
+        try:
+            session.quit()
+        except Exception:
+            session.close()
+
+    @staticmethod
+    def _send(session, path):
+        with open(path, "rb") as f:
+            msg = email.message_from_binary_file(f, policy=email.policy.default)
+        session.send_message(msg)
+        os.remove(path)
+        return msg["To"]
+
+    async def _deliver(self, session, path):
+        """Send one spooled message; returns the session to reuse (or None)."""
+        for attempt in range(SEND_RETRIES + 1):
+            if self._down:
+                return None
+            try:
+                session = session or await asyncio.to_thread(self._open)
+                to_addr = await asyncio.to_thread(self._send, session, path)
+                logger.debug("Forwarded message to %s", to_addr)
+                self._sent += 1
+                metrics.count("forwards", result="sent")
+                return session
+            except Exception as e:
+                if is_permanent(e):
+                    failed = os.path.join(self.spool, "failed")
+                    os.makedirs(failed, exist_ok=True)
+                    os.replace(path, os.path.join(failed, os.path.basename(path)))
+                    logger.error("Forward rejected, kept in %s: %s", failed, e)
+                    metrics.count("forwards", result="rejected")
+                    return session
+                if session is not None:
+                    await asyncio.to_thread(self._close, session)
+                    session = None
+                if attempt == SEND_RETRIES:
+                    # the server is unreachable; stop trying until the next run
+                    self._down = True
+                    logger.error("Failed to forward message, left in %s for the next run: %s", self.spool, e)
+                    metrics.count("forwards", result="deferred")
+                    return None
+                delay = min(RETRY_DELAY * 2 ** attempt, MAX_RETRY_DELAY)
+                logger.warning("Forward failed (%s); retrying in %ss", e, delay)
+                await asyncio.sleep(delay)
+
+    async def _worker(self):
+        session = None
+        try:
+            while (path := await self._queue.get()) is not None:
+                session = await self._deliver(session, path)
+        finally:
+            if session is not None:
+                await asyncio.to_thread(self._close, session)
+
+    async def forward(self, raw_bytes, to_addr):
+        self._start()
+        msg = build_forward(raw_bytes, self.user, to_addr)
+        await self._queue.put(await asyncio.to_thread(self._write_spool, msg))
+
+    async def drain(self):
+        """Send everything spooled, then log out of the SMTP sessions."""
+        self._start()
+        for _ in self._workers:
+            await self._queue.put(None)
+        await asyncio.gather(*self._workers)
+        self._queue, self._workers = None, []
+        if self._sent:
+            logger.info("Forwarded %d messages", self._sent)
+            self._sent = 0
+
+class Account:
+    """One mail account: its logins and where its rules and local state live.
+
+    filer.py and train_rules.py build one from their environment settings;
+    accounts.py builds one per entry of its config, each with its own rules,
+    checkpoint, header cache and spool, and the ConnectionLimit of its IMAP
+    server.
+    """
+
+    def __init__(self, name, imap_host, imap_user, imap_pass, smtp_host, smtp_user, smtp_pass,
+                 spool, rules_file, rules_db, state_file, header_cache, limit=None,
+                 imap_port=None, smtp_port=None):
+        self.name = name
+        self.imap_host, self.imap_user, self.imap_pass = imap_host, imap_user, imap_pass
+        self.smtp_host, self.smtp_user, self.smtp_pass = smtp_host, smtp_user, smtp_pass
+        self.spool = spool
+        self.rules_file, self.rules_db = rules_file, rules_db
+        self.state_file, self.header_cache = state_file, header_cache
+        self.limit = limit
+        self.imap_port, self.smtp_port = imap_port, smtp_port
+
+    def label(self, mailbox):
+        """mailbox as shown in log lines ("name/INBOX" when running several accounts)."""
+        return f"{self.name}/{mailbox}" if self.name else mailbox
+
+    async def connect(self):
+        return await AsyncIMAP.connect(self.imap_host, self.imap_user, self.imap_pass, self.limit, self.imap_port)
+
+    def smtp(self):
+        return AsyncSMTP(self.smtp_host, self.smtp_user, self.smtp_pass, self.spool, self.smtp_port)
+
+    async def fetch_sharded(self, mailbox, uids, spec, handle, pool=None):
+        """fetch_sharded() over up to WORKERS extra connections.
+
+        Under a ConnectionLimit only the slots free right now are used.
+        Returns None when fewer than two are, or when the server refuses one
+        of the connections, and the caller fetches on its own connection
+        instead.
+        """
+        workers = mailio.WORKERS
+        if self.limit is not None:
+            workers = await self.limit.reserve(workers)
+            if workers < 2:
+                self.limit.release_many(workers)
+                return None
+        try:
+            logger.debug("Fetching %d messages from %s over %d connections", len(uids), self.label(mailbox), workers)
+            connect = lambda: AsyncIMAP.connect(self.imap_host, self.imap_user, self.imap_pass, port=self.imap_port)
+            return await fetch_sharded(connect, mailbox, uids, spec, handle, workers, pool)
+        finally:
+            if self.limit is not None:
+                self.limit.release_many(workers)
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+# Correctness checks for rule matching and the failure paths, against the
+# local fake IMAP and SMTP servers (no mail account needed):
+#
+#   python3 bench/checks.py                      # every check
+#   python3 bench/checks.py failed_move_is_retried
+#
+# HOME is a temp dir, so none of your rules, state or caches are touched.
+# Exits 1 if any check fails.
+import asyncio, hashlib, json, logging, os, random, sqlite3, subprocess, sys, tempfile, time, traceback
+
+HOME = tempfile.mkdtemp(prefix="imap-checks.")
+os.environ.update(HOME=HOME, IMAP_SSL="0", SMTP_SSL="0")
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+from fakeimap import FakeIMAPServer
+from fakesmtp import DROP, FakeSMTPServer
+import asyncmail, compact_rules, filer, headercache, mailio, metrics, train_rules
+from asyncmail import Account
+from mailio import capabilities, idle_wait, noop_wait
+from matcher import RULE_HEADERS, RuleMatcher
+from replay import outcome
+from rulestore import RuleStore
+
+MOVE_NEWS = [{"match": {"header": "From", "contains": "news.example.org"}, "actions": [{"move": "News"}]}]
+
+def message(i, frm="news@news.example.org", extra=""):
+    return (f"From: {frm}\r\nSubject: message {i}\r\nMessage-ID: <c{i}@checks>\r\n{extra}"
+            f"\r\nbody {i}\r\n").encode()
+
+def account(imap, name, smtp_port=None):
+    home = os.path.join(HOME, name)
+    os.makedirs(home, exist_ok=True)
+    return Account(name, "127.0.0.1", "u", "p", "127.0.0.1", "u", "p",
+                   os.path.join(home, "spool"), os.path.join(home, "rules.yaml"), os.path.join(home, "rules.db"),
+                   os.path.join(home, "state.json"), os.path.join(home, "header-cache.db"),
+                   imap_port=imap.port, smtp_port=smtp_port)
+
+async def file_once(acct, rules, mailboxes=("INBOX",)):
+    aimap = await acct.connect()
+    try:
+        caps = await aimap.call(capabilities)
+        return await filer.file_account(acct, aimap, acct.smtp(), caps, rules, mailboxes)
+    finally:
+        await aimap.logout()
+
+# --- checks ---------------------------------------------------------------
+def failed_move_is_retried():
+    srv = FakeIMAPServer().start()
+    try:
+        for i in range(3):
+            srv.store.deliver("INBOX", message(i))
+        acct = account(srv, "retry")
+        srv.fail["UID MOVE"] = 1
+        asyncio.run(file_once(acct, MOVE_NEWS))
+        assert len(srv.store.mailbox("INBOX").messages) == 3, "the injected MOVE failure did not happen"
+        state = filer.load_state(acct.state_file)["INBOX"]
+        assert state["last_uid"] == 0 and state["highestmodseq"] is None, state
+        # nothing new has arrived; the next run must still pick the messages up
+        asyncio.run(file_once(acct, MOVE_NEWS))
+        assert not srv.store.mailbox("INBOX").messages, "failed messages were not retried"
+        assert len(srv.store.mailbox("News").messages) == 3
+        assert filer.load_state(acct.state_file)["INBOX"]["last_uid"] == 3
+    finally:
+        srv.stop()
+
+def bad_unsubscribe_header_is_skipped():
+    bad = "List-Unsubscribe: <http://[oops/unsub>, <mailto:leave@lists.example.net>\r\n"
+    srv = FakeIMAPServer().start()
+    try:
+        srv.store.deliver("INBOX", message(0, "shop@shop.example.com", bad))
+        srv.store.deliver("INBOX", message(1))
+        rules = [{"match": {"header": "List-Unsubscribe", "contains": "lists.example.net"},
+                  "actions": [{"move": "Lists"}]}] + MOVE_NEWS
+        acct = account(srv, "badheader")
+        asyncio.run(file_once(acct, rules))
+        # the valid mailto: part still matches; the broken URL is ignored
+        assert len(srv.store.mailbox("Lists").messages) == 1
+        assert len(srv.store.mailbox("News").messages) == 1
+        assert filer.load_state(acct.state_file)["INBOX"]["last_uid"] == 2
+    finally:
+        srv.stop()
+
+def sharded_full_fetch_forwards_without_refetch():
+    srv, smtp = FakeIMAPServer().start(), FakeSMTPServer().start()
+    saved = filer.FETCH_MODE, filer.FETCH_CHUNK, filer.WORKERS, mailio.FETCH_CHUNK, mailio.WORKERS
+    try:
+        body = "x" * 100000
+        for i in range(6):
+            srv.store.deliver("INBOX", message(i, "bookings@air.example", f"X-Pad: {i}\r\n") + body.encode())
+        rules = [{"match": {"header": "From", "contains": "air.example"},
+                  "actions": [{"forward": "plans@example.net"}, {"move": "Travel"}]}]
+        # FILER_FETCH=full with a backfill big enough to be sharded
+        filer.FETCH_MODE, filer.FETCH_CHUNK, filer.WORKERS = "full", 2, 2
+        mailio.FETCH_CHUNK, mailio.WORKERS = 2, 2
+        sent = srv.store.bytes_out
+        asyncio.run(file_once(account(srv, "sharded", smtp.port), rules))
+        assert smtp.counters.messages == 6 and len(srv.store.mailbox("Travel").messages) == 6
+        # each body crosses the wire once, not once to match and again to forward
+        assert srv.store.bytes_out - sent < 6 * len(body) * 1.5, srv.store.bytes_out - sent
+    finally:
+        filer.FETCH_MODE, filer.FETCH_CHUNK, filer.WORKERS, mailio.FETCH_CHUNK, mailio.WORKERS = saved
+        srv.stop()
+        smtp.stop()
+
+def refused_worker_logins_fall_back():
+    srv = FakeIMAPServer().start()
+    saved = filer.FETCH_CHUNK, filer.WORKERS, mailio.FETCH_CHUNK, mailio.WORKERS
+    try:
+        for i in range(6):
+            srv.store.deliver("INBOX", message(i))
+        filer.FETCH_CHUNK, filer.WORKERS = 2, 3
+        mailio.FETCH_CHUNK, mailio.WORKERS = 2, 3
+        acct = account(srv, "workerlogin")
+
+        async def run():
+            aimap = await acct.connect()
+            try:
+                # the server lets this connection in but refuses any more
+                srv.fail["LOGIN"] = 100
+                caps = await aimap.call(capabilities)
+                await filer.file_account(acct, aimap, acct.smtp(), caps, MOVE_NEWS, ("INBOX",))
+            finally:
+                await aimap.logout()
+
+        asyncio.run(run())
+        assert srv.fail["LOGIN"] < 100, "no worker connection was tried"
+        assert not srv.store.mailbox("INBOX").messages and len(srv.store.mailbox("News").messages) == 6
+        assert filer.load_state(acct.state_file)["INBOX"]["last_uid"] == 6
+    finally:
+        filer.FETCH_CHUNK, filer.WORKERS, mailio.FETCH_CHUNK, mailio.WORKERS = saved
+        srv.stop()
+
+def training_leaves_the_rule_store_unlocked():
+    srv = FakeIMAPServer().start()
+    try:
+        for i in range(3):
+            srv.store.deliver("Train/News", message(i, f"news@news{i}.example.org"))
+        acct = account(srv, "trainlock")
+        probed = []
+
+        def filer_records_hits():
+            # runs while the trainer moves the folder's mail, after it has
+            # learned every key and before it saves them
+            try:
+                store = RuleStore(acct.rules_db, acct.rules_file, timeout=0.2)
+                try:
+                    store.record_hits({})
+                finally:
+                    store.close()
+                probed.append("ok")
+            except sqlite3.OperationalError as e:
+                probed.append(str(e))
+
+        srv.before["UID MOVE"] = filer_records_hits
+
+        async def run():
+            aimap = await acct.connect()
+            try:
+                caps = await aimap.call(capabilities)
+                return await train_rules.train_account(acct, aimap, acct.smtp(), caps,
+                                                       {"Train/News": [("move", "News")]})
+            finally:
+                await aimap.logout()
+
+        assert asyncio.run(run()) == 3
+        assert probed == ["ok"], probed
+        store = RuleStore(acct.rules_db, acct.rules_file)
+        try:
+            assert len(store) == 3, store.rules()
+        finally:
+            store.close()
+    finally:
+        srv.stop()
+
+def mail_during_pass_is_noticed():
+    srv = FakeIMAPServer().start()
+    try:
+        for i in range(2):
+            srv.store.deliver("INBOX", message(i))
+        acct = account(srv, "midpass")
+        matcher = RuleMatcher(MOVE_NEWS)
+
+        async def watch_once(wait, uid):
+            # mail lands while the pass moves messages: the server announces
+            # it in the MOVE reply, and the wait must return without sleeping
+            srv.before["UID MOVE"] = lambda: srv.store.deliver("INBOX", message(uid))
+            await filer.file_mailbox(acct, aimap, smtp, caps, MOVE_NEWS, matcher)
+            assert [m.uid for m in srv.store.mailbox("INBOX").messages.values()] == [uid + 1]
+            started = time.monotonic()
+            assert await aimap.call(wait, 30), f"{wait.__name__} missed the new mail"
+            assert time.monotonic() - started < 5, f"{wait.__name__} waited for the timeout"
+
+        async def run():
+            nonlocal aimap, smtp, caps
+            aimap, smtp = await acct.connect(), acct.smtp()
+            try:
+                caps = await aimap.call(capabilities)
+                await watch_once(idle_wait, 2)
+                await watch_once(noop_wait, 3)
+                await filer.file_mailbox(acct, aimap, smtp, caps, MOVE_NEWS, matcher)
+            finally:
+                await aimap.logout()
+
+        aimap = smtp = caps = None
+        asyncio.run(run())
+        assert not srv.store.mailbox("INBOX").messages and len(srv.store.mailbox("News").messages) == 4
+    finally:
+        srv.stop()
+
+def unusable_header_cache_is_skipped():
+    srv = FakeIMAPServer().start()
+    saved = headercache.LOCK_TIMEOUT
+    try:
+        headercache.LOCK_TIMEOUT = 0.2
+        acct = account(srv, "lockedcache")
+        srv.store.deliver("INBOX", message(0))
+        asyncio.run(file_once(acct, MOVE_NEWS))
+        # another process is writing to the cache: filing goes on without it
+        other = sqlite3.connect(acct.header_cache)
+        other.execute("BEGIN IMMEDIATE")
+        try:
+            for i in range(1, 4):
+                srv.store.deliver("INBOX", message(i))
+            asyncio.run(file_once(acct, MOVE_NEWS))
+        finally:
+            other.rollback()
+            other.close()
+        assert len(srv.store.mailbox("News").messages) == 4
+        assert filer.load_state(acct.state_file)["INBOX"]["last_uid"] == 4
+        # a damaged cache file is the same as no cache
+        with open(acct.header_cache, "wb") as f:
+            f.write(b"not a database" * 100)
+        srv.store.deliver("INBOX", message(4))
+        asyncio.run(file_once(acct, MOVE_NEWS))
+        assert len(srv.store.mailbox("News").messages) == 5
+        # ... including one that turns out to be damaged once open (SQLite
+        # only notices when it reads the broken page)
+        class Malformed:
+            def execute(self, *args):
+                raise sqlite3.DatabaseError("database disk image is malformed")
+            executemany = execute
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc):
+                return False
+            def close(self):
+                pass
+        cache = headercache.HeaderCache(acct.header_cache)
+        cache.db.close()
+        cache.db = Malformed()
+        box = cache.mailbox("INBOX", 1)
+        box.put(1, headercache.parse_features(message(1)))
+        cache.flush()
+        assert box.get_many(["1", "2"]) == {}
+        cache.close()
+        # a server that reports no UIDVALIDITY: the cache is not used at all
+        select = filer.select_mailbox
+        filer.select_mailbox = lambda *a, **kw: dict(select(*a, **kw), uidvalidity=None)
+        try:
+            os.remove(acct.header_cache)
+            srv.store.deliver("INBOX", message(5))
+            asyncio.run(file_once(acct, MOVE_NEWS))
+        finally:
+            filer.select_mailbox = select
+        assert len(srv.store.mailbox("News").messages) == 6
+        assert filer.load_state(acct.state_file)["INBOX"]["last_uid"] == 6
+        cache = headercache.HeaderCache(acct.header_cache)
+        try:
+            assert not list(cache.entries())
+        finally:
+            cache.close()
+    finally:
+        headercache.LOCK_TIMEOUT = saved
+        srv.stop()
+
+def replay_writes_nothing():
+    path = os.path.join(HOME, "replay-cache.db")
+    cache = headercache.HeaderCache(path)
+    box = cache.mailbox("INBOX", 1)
+    for i in range(10):
+        box.put(i, headercache.parse_features(message(i)))
+    cache.close()
+    rules = os.path.join(HOME, "replay-rules.yaml")
+    with open(rules, "w") as f:
+        f.write("rules:\n  - match: {header: From, contains: news.example.org}\n    actions: [{move: News}]\n")
+    store = os.path.join(HOME, "replay-rules.db")
+
+    def replay():
+        # over HEADER_CACHE_SIZE, so a writable close() would evict
+        env = dict(os.environ, HEADER_CACHE=path, HEADER_CACHE_SIZE="3", RULES_DB=store)
+        out = subprocess.run([sys.executable, os.path.join(os.path.dirname(HERE), "replay.py"),
+                              "--cache", "--rules", rules], env=env, capture_output=True, text=True)
+        assert out.returncode == 0, out.stderr
+
+    def digest(p):
+        with open(p, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    before = digest(path)
+    replay()  # fresh install: no rule store yet
+    assert not os.path.exists(store), "replay.py created the rule store"
+    assert digest(path) == before, "replay.py --cache wrote to the header cache"
+    RuleStore(store, rules).close()
+    stored = digest(store)
+    replay()
+    assert digest(store) == stored, "replay.py wrote to the rule store"
+
+def reference_match(rules, features):
+    """First-match-wins the slow way: each rule in turn, as the filer used to."""
+    for idx, rule in enumerate(rules):
+        m = rule.get("match") or {}
+        hdr = str(m.get("header", "")).lower()
+        if hdr not in RULE_HEADERS or m.get("contains") is None:
+            continue  # unsupported: never matches
+        needle = str(m["contains"]).lower()
+        value = features[hdr]
+        # List-Unsubscribe is a list of domains; no domains, no match
+        if any(needle in text for text in (value if isinstance(value, list) else [value])):
+            return idx
+    return None
+
+def random_message(rnd):
+    word = lambda: "".join(rnd.choice("abAB.-") for _ in range(rnd.randint(0, 6)))
+    headers = [f"From: {word()} <{word()}@{word()}.example>", f"Subject: {word()} {word()}"]
+    if rnd.random() < 0.5:
+        headers.append(f"List-Id: <{word()}.list>")
+    unsub = rnd.choice([None, f"<mailto:u@{word()}.example>", f"<https://{word()}.example/u>",
+                        "<http://[oops/>", "no-brackets"])
+    if unsub:
+        headers.append(f"List-Unsubscribe: {unsub}")
+    return ("\r\n".join(headers) + "\r\n\r\nbody\r\n").encode()
+
+def random_rules(rnd):
+    rules = []
+    for _ in range(rnd.randint(1, 12)):
+        header = rnd.choice(["From", "Subject", "List-Id", "List-Unsubscribe", "any", "To", "X-Mailer"])
+        contains = rnd.choice([None, ""] + ["".join(rnd.choice("abAB.-") for _ in range(rnd.randint(1, 3)))] * 6)
+        rules.append({"match": {"header": header, "contains": contains}, "actions": [{"move": "X"}]})
+    return rules
+
+def matcher_agrees_with_reference():
+    features = headercache.parse_features(message(0, "Shop <deals@shop.example>",
+                                                   "List-Unsubscribe: <http://[oops/>\r\n"))
+    assert features["list-unsubscribe"] == []
+    cases = [
+        # (rules, expected index)
+        ([{"match": {"header": "Subject", "contains": ""}}], 0),  # empty needle matches any text
+        ([{"match": {"header": "List-Unsubscribe", "contains": ""}}], None),  # ... but not an empty list
+        ([{"match": {"header": "To", "contains": "shop"}}, {"match": {"header": "any", "contains": "DEALS@"}}], 1),
+        ([{"match": {"header": "any", "contains": "example> message"}}], 0),  # any spans From and Subject
+        ([{"match": {"header": "From", "contains": None}}, {"match": {"header": "from", "contains": "shop"}}], 1),
+        ([{"match": {"header": "List-Id", "contains": "shop"}}], None),
+    ]
+    logging.getLogger("matcher").setLevel(logging.ERROR)  # the unsupported rules are on purpose
+    try:
+        for rules, expected in cases:
+            assert reference_match(rules, features) == expected, (rules, expected)
+            assert RuleMatcher(rules).match(features)[0] == expected, (rules, expected)
+        # random rulesets over a tiny alphabet, so needles overlap a lot
+        rnd = random.Random(4)
+        for _ in range(300):
+            rules = random_rules(rnd)
+            matcher = RuleMatcher(rules)
+            for _ in range(20):
+                features = headercache.parse_features(random_message(rnd))
+                assert matcher.match(features)[0] == reference_match(rules, features), (rules, features)
+    finally:
+        logging.getLogger("matcher").setLevel(logging.NOTSET)
+
+def rule(header, contains, dest):
+    return {"match": {"header": header, "contains": contains}, "actions": [{"move": dest}]}
+
+def compact_rules_finds_redundant_rules():
+    analyse = compact_rules.analyse
+    # an earlier, more general rule always wins
+    assert analyse([rule("From", "example.com", "A"), rule("From", "news.example.com", "B")]) == {1: ("shadowed", 0)}
+    # "any" covers From, Subject and List-Id, but not List-Unsubscribe
+    assert analyse([rule("any", "shop", "A"), rule("Subject", "shop sale", "B"),
+                    rule("List-Unsubscribe", "shop.example", "C")]) == {1: ("shadowed", 0)}
+    assert analyse([rule("Subject", "shop", "A"), rule("any", "shop", "B")]) == {}
+    # a later, more general rule would file the mail the same way anyway
+    assert analyse([rule("From", "news.example.com", "A"), rule("From", "example.com", "A")]) == {0: ("subsumed", 1)}
+    # ... unless a rule in between files some of it differently
+    assert analyse([rule("From", "news.example.com", "A"), rule("Subject", "urgent", "B"),
+                    rule("From", "example.com", "A")]) == {}
+    assert analyse([rule("From", "news.example.com", "A"), rule("Subject", "urgent", "A"),
+                    rule("From", "example.com", "A")]) == {0: ("subsumed", 2)}
+    assert analyse([rule("To", "me", "A"), {"match": {"header": "From"}}]) == {0: ("unsupported", None),
+                                                                             1: ("unsupported", None)}
+
+def compact_rules_credits_hits_to_the_covering_rule():
+    rules = [rule("From", "news.example.com", "A"), rule("From", "example.com", "A"), rule("From", "old.example", "B")]
+    redundant = compact_rules.analyse(rules)
+    assert redundant == {0: ("subsumed", 1)}
+    stats = {("From", "news.example.com"): (40, 0, 1000.0),  # takes every hit, being first
+             ("From", "example.com"): (0, 500, None),
+             ("From", "old.example"): (3, 500, 10.0)}
+    dead = compact_rules.dead_rules(rules, stats, redundant, 200)
+    # without rule 0 its mail goes to rule 1, so rule 1 is not dead
+    assert dead == {2: (3, 500, 10.0)}, dead
+    assert compact_rules.dead_rules(rules, stats, {}, 200) == {1: (0, 500, None), 2: (3, 500, 10.0)}
+
+def pruning_does_not_change_filing():
+    rules = [rule("From", "example.com", "A"), rule("From", "news.example.com", "B"),  # 1 shadowed
+             rule("Subject", "sale", "C"), rule("Subject", "urgent", "D"),
+             rule("any", "big sale", "C"),  # kept: the text may span From and Subject
+             rule("List-Id", "list.example", "E"), rule("List-Id", "example", "E"),  # 5 subsumed
+             rule("Subject", "notice", "F"),
+             rule("From", "shop.example.org", "G"), rule("Subject", "offer", "H"),  # kept: offer files differently
+             rule("From", "example.org", "G")]
+    path, yaml_path = os.path.join(HOME, "prune-rules.db"), os.path.join(HOME, "prune-rules.yaml")
+    with open(yaml_path, "w") as f:
+        f.write("rules:\n" + "".join(f"  - {json.dumps(r)}\n" for r in rules))
+    out = subprocess.run([sys.executable, os.path.join(os.path.dirname(HERE), "compact_rules.py"),
+                          "--db", path, "--rules", yaml_path, "--prune"], capture_output=True, text=True)
+    assert out.returncode == 0, out.stderr
+    store = RuleStore(path, yaml_path)
+    try:
+        store.sync()
+        pruned = store.rules()
+    finally:
+        store.close()
+    kept = [r["match"]["contains"] for r in pruned]
+    assert kept == ["example.com", "sale", "urgent", "big sale", "example", "notice",
+                    "shop.example.org", "offer", "example.org"], kept
+    before, after = RuleMatcher(rules), RuleMatcher(pruned)
+    rnd = random.Random(19)
+    words = ["example.com", "news.example.com", "sale", "big sale", "urgent", "notice", "list.example",
+             "shop.example.org", "example.org", "offer", "x"]
+    for _ in range(2000):
+        raw = (f"From: {rnd.choice(words)}\r\nSubject: {rnd.choice(words)} {rnd.choice(words)}\r\n"
+               f"List-Id: <{rnd.choice(words)}>\r\n\r\n").encode()
+        features = headercache.parse_features(raw)
+        assert outcome(before.match(features)[1]) == outcome(after.match(features)[1]), features
+
+def spooled(acct, sub=""):
+    return sorted(f for f in os.listdir(os.path.join(acct.spool, sub)) if f.endswith(".eml"))
+
+async def forward_all(smtp, count):
+    for i in range(count):
+        await smtp.forward(message(i), "plans@example.net")
+    await smtp.drain()
+
+def transient_forward_failure_is_retried():
+    srv, smtp = FakeIMAPServer().start(), FakeSMTPServer().start()
+    saved = asyncmail.RETRY_DELAY
+    try:
+        asyncmail.RETRY_DELAY = 0.01
+        acct = account(srv, "smtpretry", smtp.port)
+        # a dropped connection and a 4xx are retried within the run
+        smtp.fail["DATA"] = [DROP]
+        smtp.fail["MAIL"] = ["451 4.3.0 try again later"]
+        smtp.fail["RCPT"] = ["451 4.3.0 try again later"]
+        asyncio.run(forward_all(acct.smtp(), 3))
+        assert smtp.counters.messages == 3 and not spooled(acct)
+        assert not os.path.exists(os.path.join(acct.spool, "failed")), "a 4xx was treated as permanent"
+        # a server that stays down: the forward waits in the spool ...
+        smtp.fail["MAIL"] = ["421 4.3.2 service not available"] * (asyncmail.SEND_RETRIES + 1)
+        asyncio.run(forward_all(acct.smtp(), 1))
+        assert smtp.counters.messages == 3 and len(spooled(acct)) == 1
+        # ... and goes out from there on the next run
+        asyncio.run(acct.smtp().drain())
+        assert smtp.counters.messages == 4 and not spooled(acct)
+    finally:
+        asyncmail.RETRY_DELAY = saved
+        srv.stop()
+        smtp.stop()
+
+def permanent_forward_failure_is_kept():
+    srv, smtp = FakeIMAPServer().start(), FakeSMTPServer().start()
+    try:
+        acct = account(srv, "smtpreject", smtp.port)
+        smtp.fail["RCPT"] = ["550 5.1.1 no such user"]
+        smtp.fail["DATA"] = [None, "554 5.7.1 message refused"]
+        asyncio.run(forward_all(acct.smtp(), 3))
+        # the one accepted message is sent; the refused two are not retried
+        assert smtp.counters.messages == 1, smtp.counters.messages
+        assert not spooled(acct) and len(spooled(acct, "failed")) == 2
+        asyncio.run(acct.smtp().drain())
+        assert smtp.counters.messages == 1 and len(spooled(acct, "failed")) == 2
+    finally:
+        srv.stop()
+        smtp.stop()
+
+CHECKS = [matcher_agrees_with_reference, compact_rules_finds_redundant_rules,
+          compact_rules_credits_hits_to_the_covering_rule, pruning_does_not_change_filing,
+          failed_move_is_retried, bad_unsubscribe_header_is_skipped, sharded_full_fetch_forwards_without_refetch,
+          refused_worker_logins_fall_back, training_leaves_the_rule_store_unlocked, mail_during_pass_is_noticed,
+          unusable_header_cache_is_skipped, replay_writes_nothing, transient_forward_failure_is_retried,
+          permanent_forward_failure_is_kept]
+
+def main():
+    metrics.start("checks")
+    names = sys.argv[1:]
+    failed = 0
+    for check in CHECKS:
+        if names and check.__name__ not in names:
+            continue
+        try:
+            check()
+            print(f"ok    {check.__name__}")
+        except Exception:
+            failed += 1
+            print(f"FAIL  {check.__name__}\n{traceback.format_exc()}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
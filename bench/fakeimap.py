@@ -0,0 +1,452 @@
+# bench/fakeimap.py
+# Minimal in-process IMAP4rev1 stand-in for benchmarks.
+#
+# Speaks just enough plaintext IMAP for filer.py and train_rules.py: LOGIN,
+# SELECT/EXAMINE (with CONDSTORE), UID SEARCH/FETCH/STORE/COPY/MOVE, CREATE,
+# APPEND, EXPUNGE, NOOP and IDLE. New mail is announced with EXISTS in reply
+# to any command, as real servers do. Every command can be delayed by a fixed
+# latency to model a remote server, and the server counts commands and bytes.
+import bisect, re, socket, socketserver, threading, time
+
+CAPABILITIES = "IMAP4rev1 IDLE UIDPLUS MOVE CONDSTORE LITERAL+"
+
+class Message:
+    __slots__ = ("uid", "raw", "flags", "modseq")
+
+    def __init__(self, uid, raw, flags=(), modseq=1):
+        self.uid, self.raw, self.flags, self.modseq = uid, raw, set(flags), modseq
+
+class Mailbox:
+    def __init__(self, name, uidvalidity=1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.highestmodseq = 1
+        self.messages = {}
+        self._uids = None
+
+    def add(self, raw, flags=()):
+        uid = self.uidnext
+        self.uidnext += 1
+        self.highestmodseq += 1
+        self.messages[uid] = Message(uid, raw, flags, self.highestmodseq)
+        self._uids = None
+        return uid
+
+    def remove(self, uid):
+        del self.messages[uid]
+        self._uids = None
+
+    def uids(self):
+        # UIDs only grow, so insertion order is UID order
+        if self._uids is None:
+            self._uids = list(self.messages)
+        return self._uids
+
+    def select(self, spec):
+        """[(sequence number, uid)] for a UID set, in UID order."""
+        uids = self.uids()
+        found = set()
+        for a, b in parse_uid_set(spec, uids[-1] if uids else 0):
+            found.update(range(bisect.bisect_left(uids, a), bisect.bisect_right(uids, b)))
+        return [(i + 1, uids[i]) for i in sorted(found)]
+
+    def touch(self, msg):
+        self.highestmodseq += 1
+        msg.modseq = self.highestmodseq
+
+class Store:
+    """Shared mailbox state; safe to mutate from the benchmark thread."""
+
+    def __init__(self):
+        self.mailboxes = {"INBOX": Mailbox("INBOX")}
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def mailbox(self, name, create=False):
+        if name.upper() == "INBOX":
+            name = "INBOX"
+        if create and name not in self.mailboxes:
+            self.mailboxes[name] = Mailbox(name, uidvalidity=len(self.mailboxes) + 1)
+        return self.mailboxes.get(name)
+
+    def deliver(self, name, raw, flags=()):
+        with self.lock:
+            uid = self.mailbox(name, create=True).add(raw, flags)
+            self.changed.notify_all()
+            return uid
+
+def parse_uid_set(spec, maximum):
+    out = []
+    for part in spec.split(","):
+        if ":" in part:
+            a, b = part.split(":", 1)
+            a = maximum if a == "*" else int(a)
+            b = maximum if b == "*" else int(b)
+            if a > b:
+                a, b = b, a
+            out.append((a, b))
+        else:
+            n = maximum if part == "*" else int(part)
+            out.append((n, n))
+    return out
+
+def header_fields(raw, names):
+    head = raw.split(b"\r\n\r\n", 1)[0] + b"\r\n"
+    wanted = {n.lower() for n in names}
+    out, keep = [], False
+    for line in head.split(b"\r\n"):
+        if not line:
+            continue
+        if line[:1] in (b" ", b"\t"):
+            if keep:
+                out.append(line)
+            continue
+        keep = line.split(b":", 1)[0].strip().decode("ascii", "replace").lower() in wanted
+        if keep:
+            out.append(line)
+    return b"\r\n".join(out) + (b"\r\n" if out else b"") + b"\r\n"
+
+class Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+        self.store = self.server.store
+        self.selected = None
+        self.readonly = False
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.store.bytes_out += len(data)
+        self.wfile.write(data)
+
+    def readline(self):
+        line = self.rfile.readline()
+        self.store.bytes_in += len(line)
+        return line
+
+    def read_literal(self, line):
+        """Return command line with any trailing {n} literal inlined as bytes."""
+        parts = []
+        while True:
+            m = re.search(rb"\{(\d+)(\+?)\}\r\n$", line)
+            if not m:
+                parts.append(line.rstrip(b"\r\n"))
+                return parts
+            parts.append(line[:m.start()])
+            if not m.group(2):
+                self.send("+ Ready\r\n")
+            data = self.rfile.read(int(m.group(1)))
+            self.store.bytes_in += len(data)
+            parts.append(data)
+            line = self.readline()
+
+    def handle(self):
+        self.send("* OK fakeimap ready\r\n")
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            parts = self.read_literal(line)
+            head = parts[0].decode("utf-8", "replace")
+            tokens = head.split(" ", 2)
+            if len(tokens) < 2:
+                self.send("* BAD malformed\r\n")
+                continue
+            tag, cmd = tokens[0], tokens[1].upper()
+            args = tokens[2] if len(tokens) > 2 else ""
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            with self.store.lock:
+                self.store.commands += 1
+            name = "UID " + args.split(" ", 1)[0].upper() if cmd == "UID" else cmd
+            if name in self.server.before:
+                self.server.before.pop(name)()
+            # like real servers, announce new mail in reply to any command
+            self.untagged_updates()
+            if self.server.fail.get(name):
+                self.server.fail[name] -= 1
+                self.send("%s NO [SERVERBUG] injected failure\r\n" % tag)
+                continue
+            try:
+                if cmd == "UID":
+                    sub, _, rest = args.partition(" ")
+                    getattr(self, "uid_" + sub.lower())(tag, rest)
+                elif cmd == "APPEND":
+                    self.cmd_append(tag, args, parts)
+                elif cmd == "LOGOUT":
+                    self.send("* BYE logging out\r\n%s OK LOGOUT completed\r\n" % tag)
+                    return
+                else:
+                    getattr(self, "cmd_" + cmd.lower())(tag, args)
+            except AttributeError:
+                self.send("%s BAD unknown command %s\r\n" % (tag, cmd))
+            except Exception as e:
+                self.send("%s NO %s\r\n" % (tag, e))
+
+    # --- plain commands -------------------------------------------------
+    def cmd_capability(self, tag, args):
+        self.send("* CAPABILITY %s\r\n%s OK CAPABILITY completed\r\n" % (self.server.capabilities, tag))
+
+    def cmd_login(self, tag, args):
+        self.send("* CAPABILITY %s\r\n%s OK LOGIN completed\r\n" % (self.server.capabilities, tag))
+
+    def cmd_noop(self, tag, args):
+        self.untagged_updates()
+        self.send("%s OK NOOP completed\r\n" % tag)
+
+    def cmd_enable(self, tag, args):
+        self.send("* ENABLED %s\r\n%s OK ENABLE completed\r\n" % (args, tag))
+
+    def cmd_create(self, tag, args):
+        name = args.strip().strip('"')
+        with self.store.lock:
+            if self.store.mailbox(name):
+                self.send("%s NO [ALREADYEXISTS] mailbox exists\r\n" % tag)
+                return
+            self.store.mailbox(name, create=True)
+        self.send("%s OK CREATE completed\r\n" % tag)
+
+    def cmd_select(self, tag, args, readonly=False):
+        name = args.split(" (", 1)[0].strip().strip('"')
+        with self.store.lock:
+            mb = self.store.mailbox(name)
+            if mb is None:
+                self.send("%s NO [NONEXISTENT] no such mailbox\r\n" % tag)
+                return
+            self.selected, self.readonly = mb, readonly
+            self.seen_count = len(mb.messages)
+            self.send(
+                "* %d EXISTS\r\n* 0 RECENT\r\n"
+                "* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n"
+                "* OK [UIDVALIDITY %d] UIDs valid\r\n"
+                "* OK [UIDNEXT %d] Predicted next UID\r\n"
+                "* OK [HIGHESTMODSEQ %d] Highest\r\n"
+                "%s OK [%s] SELECT completed\r\n"
+                % (len(mb.messages), mb.uidvalidity, mb.uidnext, mb.highestmodseq,
+                   tag, "READ-ONLY" if readonly else "READ-WRITE"))
+
+    def cmd_examine(self, tag, args):
+        self.cmd_select(tag, args, readonly=True)
+
+    def cmd_status(self, tag, args):
+        name, _, items = args.partition(" ")
+        name = name.strip('"')
+        with self.store.lock:
+            mb = self.store.mailbox(name)
+            if mb is None:
+                self.send("%s NO no such mailbox\r\n" % tag)
+                return
+            self.send("* STATUS \"%s\" (MESSAGES %d UIDNEXT %d UIDVALIDITY %d HIGHESTMODSEQ %d)\r\n"
+                      "%s OK STATUS completed\r\n"
+                      % (name, len(mb.messages), mb.uidnext, mb.uidvalidity, mb.highestmodseq, tag))
+
+    def cmd_expunge(self, tag, args):
+        with self.store.lock:
+            mb = self.selected
+            uids = mb.uids()
+            for seq in range(len(uids), 0, -1):
+                msg = mb.messages[uids[seq - 1]]
+                if "\\Deleted" in msg.flags:
+                    mb.remove(msg.uid)
+                    self.send("* %d EXPUNGE\r\n" % seq)
+            self.seen_count = len(mb.messages)
+        self.send("%s OK EXPUNGE completed\r\n" % tag)
+
+    def cmd_close(self, tag, args):
+        self.selected = None
+        self.send("%s OK CLOSE completed\r\n" % tag)
+
+    def cmd_append(self, tag, args, parts):
+        name = args.split(" ", 1)[0].strip('"')
+        flags = re.search(r"\(([^)]*)\)", args)
+        raw = parts[1] if len(parts) > 1 else b""
+        with self.store.lock:
+            mb = self.store.mailbox(name)
+            if mb is None:
+                self.send("%s NO [TRYCREATE] no such mailbox\r\n" % tag)
+                return
+            uid = mb.add(raw, flags.group(1).split() if flags else ())
+            self.store.changed.notify_all()
+        self.send("%s OK [APPENDUID %d %d] APPEND completed\r\n" % (tag, mb.uidvalidity, uid))
+
+    def cmd_idle(self, tag, args):
+        self.send("+ idling\r\n")
+        done = threading.Event()
+
+        def wait_done():
+            self.readline()
+            done.set()
+            with self.store.lock:
+                self.store.changed.notify_all()
+
+        threading.Thread(target=wait_done, daemon=True).start()
+        with self.store.lock:
+            while not done.is_set():
+                self.untagged_updates()
+                self.store.changed.wait(0.5)
+        self.send("%s OK IDLE terminated\r\n" % tag)
+
+    def untagged_updates(self):
+        mb = self.selected
+        if mb is None:
+            return
+        with self.store.lock:
+            # counts only grow here: removals by other sessions are not
+            # announced (a real server would send EXPUNGE)
+            if len(mb.messages) > self.seen_count:
+                self.send("* %d EXISTS\r\n" % len(mb.messages))
+            self.seen_count = len(mb.messages)
+
+    # --- UID commands ---------------------------------------------------
+    def uid_search(self, tag, args):
+        mb = self.selected
+        with self.store.lock:
+            uids = mb.uids()
+            crit = args.upper().split()
+            if "UID" in crit:
+                spec = args.split()[crit.index("UID") + 1]
+                uids = [u for _, u in mb.select(spec)]
+                if not uids and mb.messages and spec.endswith("*"):
+                    uids = [mb.uids()[-1]]
+            if "UNSEEN" in crit:
+                uids = [u for u in uids if "\\Seen" not in mb.messages[u].flags]
+        self.send("* SEARCH%s\r\n%s OK SEARCH completed\r\n"
+                  % ("".join(" %d" % u for u in uids), tag))
+
+    def uid_fetch(self, tag, args):
+        spec, _, items = args.partition(" ")
+        items = items.strip()
+        if items.startswith("(") and items.endswith(")"):
+            items = items[1:-1]
+        mb = self.selected
+        with self.store.lock:
+            selected = [(seq, mb.messages[u]) for seq, u in mb.select(spec)]
+        upper = items.upper()
+        fields = re.search(r"HEADER\.FIELDS \(([^)]*)\)", items, re.I)
+        for seq, msg in selected:
+            out = [b"* %d FETCH (UID %d" % (seq, msg.uid)]
+            if "RFC822" in upper.split() or "BODY[]" in upper:
+                with self.store.lock:
+                    if "\\Seen" not in msg.flags and not self.readonly:
+                        msg.flags.add("\\Seen")
+                        mb.touch(msg)
+            if "FLAGS" in upper:
+                out.append(b" FLAGS (%s)" % " ".join(sorted(msg.flags)).encode())
+            if "MODSEQ" in upper:
+                out.append(b" MODSEQ (%d)" % msg.modseq)
+            if "RFC822.SIZE" in upper:
+                out.append(b" RFC822.SIZE %d" % len(msg.raw))
+            if fields:
+                data = header_fields(msg.raw, fields.group(1).split())
+                name = ("BODY[HEADER.FIELDS (%s)]" % fields.group(1).upper()).encode()
+                out.append(b" %s {%d}\r\n%s" % (name, len(data), data))
+            elif "BODY.PEEK[]" in upper or "BODY[]" in upper:
+                out.append(b" BODY[] {%d}\r\n%s" % (len(msg.raw), msg.raw))
+            elif re.search(r"\bRFC822\b(?!\.)", upper):
+                out.append(b" RFC822 {%d}\r\n%s" % (len(msg.raw), msg.raw))
+            out.append(b")\r\n")
+            self.send(b"".join(out))
+        self.send("%s OK FETCH completed\r\n" % tag)
+
+    def uid_store(self, tag, args):
+        spec, op, flags = args.split(" ", 2)
+        flags = flags.strip("()").split()
+        silent = op.upper().endswith(".SILENT")
+        mb = self.selected
+        with self.store.lock:
+            for seq, u in mb.select(spec):
+                msg = mb.messages[u]
+                if op.startswith("+"):
+                    msg.flags.update(flags)
+                elif op.startswith("-"):
+                    msg.flags.difference_update(flags)
+                else:
+                    msg.flags = set(flags)
+                mb.touch(msg)
+                if not silent:
+                    self.send("* %d FETCH (UID %d FLAGS (%s))\r\n" % (seq, u, " ".join(sorted(msg.flags))))
+        self.send("%s OK STORE completed\r\n" % tag)
+
+    def _copy(self, spec, dest_name):
+        mb = self.selected
+        dest = self.store.mailbox(dest_name.strip().strip('"'))
+        if dest is None:
+            return None
+        src, dst = [], []
+        for _, u in mb.select(spec):
+            msg = mb.messages[u]
+            src.append(u)
+            flags = msg.flags - {"\\Deleted"}
+            if self.server.seen_on_copy:
+                flags = flags | {"\\Seen"}
+            dst.append(dest.add(msg.raw, flags))
+        self.store.changed.notify_all()
+        return dest, src, dst
+
+    def uid_copy(self, tag, args):
+        spec, _, dest = args.partition(" ")
+        with self.store.lock:
+            res = self._copy(spec, dest)
+        if res is None:
+            self.send("%s NO [TRYCREATE] no such mailbox\r\n" % tag)
+            return
+        dest, src, dst = res
+        if src and "UIDPLUS" in self.server.capabilities:
+            self.send("%s OK [COPYUID %d %s %s] COPY completed\r\n"
+                      % (tag, dest.uidvalidity, ",".join(map(str, src)), ",".join(map(str, dst))))
+        else:
+            self.send("%s OK COPY completed\r\n" % tag)
+
+    def uid_move(self, tag, args):
+        spec, _, dest = args.partition(" ")
+        with self.store.lock:
+            selected = self.selected.select(spec)
+            res = self._copy(spec, dest)
+            if res is None:
+                self.send("%s NO [TRYCREATE] no such mailbox\r\n" % tag)
+                return
+            dest, src, dst = res
+            if src and "UIDPLUS" in self.server.capabilities:
+                self.send("* OK [COPYUID %d %s %s] moved\r\n"
+                          % (dest.uidvalidity, ",".join(map(str, src)), ",".join(map(str, dst))))
+            mb = self.selected
+            for seq, u in reversed(selected):
+                mb.remove(u)
+                self.send("* %d EXPUNGE\r\n" % seq)
+            self.seen_count = len(mb.messages)
+        self.send("%s OK MOVE completed\r\n" % tag)
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store=None, latency=0.0, capabilities=CAPABILITIES,
+                 seen_on_copy=False, host="127.0.0.1", port=0):
+        self.store = store or Store()
+        self.latency = latency
+        self.capabilities = capabilities
+        # some servers flag COPY/MOVE results as \Seen; model that when asked
+        self.seen_on_copy = seen_on_copy
+        # command ("UID MOVE", "EXPUNGE", ...) -> how many of the next ones get a NO
+        self.fail = {}
+        # command -> function run once just before the next one (e.g. a delivery)
+        self.before = {}
+        super().__init__((host, port), Handler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,110 @@
+# bench/fakesmtp.py
+# Minimal in-process SMTP stand-in for benchmarks.
+#
+# Accepts EHLO, AUTH (any credentials), MAIL/RCPT/DATA, RSET, NOOP and QUIT
+# over plaintext and counts connections, logins and messages, which is all
+# the forward path needs (run the scripts with SMTP_SSL=0). Replies to MAIL,
+# RCPT and DATA can be replaced with errors, or the connection dropped, to
+# exercise the retry and spool paths.
+import socket, socketserver, threading
+
+# An injected "reply" that closes the connection without answering
+DROP = "drop"
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.logins = 0
+        self.messages = 0
+        self.bytes_in = 0
+
+class Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+        self.counters = self.server.counters
+        with self.counters.lock:
+            self.counters.connections += 1
+
+    def send(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def injected(self, verb):
+        """The next injected reply for verb (a reply line or DROP), or None."""
+        with self.counters.lock:
+            replies = self.server.fail.get(verb.decode())
+            return replies.pop(0) if replies else None
+
+    def handle(self):
+        self.send("220 fake ESMTP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            with self.counters.lock:
+                self.counters.bytes_in += len(line)
+            verb = line.split(b" ", 1)[0].strip().upper()
+            reply = self.injected(verb) if verb in (b"MAIL", b"RCPT") else None
+            if reply == DROP:
+                return
+            if reply:
+                self.send(reply)
+            elif verb == b"EHLO":
+                self.send("250-fake\r\n250-AUTH PLAIN LOGIN\r\n250-8BITMIME\r\n250 SMTPUTF8")
+            elif verb == b"HELO":
+                self.send("250 fake")
+            elif verb == b"AUTH":
+                with self.counters.lock:
+                    self.counters.logins += 1
+                self.send("235 authenticated")
+            elif verb in (b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                self.send("250 ok")
+            elif verb == b"DATA":
+                self.send("354 go ahead")
+                size = 0
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b".\r\n":
+                        break
+                    size += len(data)
+                # the message has been sent; the server may still refuse it
+                reply = self.injected(verb)
+                if reply == DROP:
+                    return
+                if reply:
+                    self.send(reply)
+                    continue
+                with self.counters.lock:
+                    self.counters.messages += 1
+                    self.counters.bytes_in += size
+                self.send("250 queued")
+            elif verb == b"QUIT":
+                self.send("221 bye")
+                return
+            else:
+                self.send("502 not implemented")
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.counters = Counters()
+        # "MAIL", "RCPT" or "DATA" -> replies used, in order, instead of the
+        # normal ones: e.g. "451 4.3.0 try again later", DROP, or None for
+        # the normal reply
+        self.fail = {}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Bytes and commands per MOVE_STRATEGY against the local fake IMAP server.
+#
+#   python3 bench/move_strategies.py --messages 500 --size 200000
+import argparse, imaplib, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from fakeimap import FakeIMAPServer
+from mailio import ActionPlan, capabilities, fetch_batched, select_mailbox
+
+def make_message(i, size):
+    head = (f"From: news{i % 7}@example.org\r\nSubject: issue {i}\r\n"
+            f"Message-ID: <{i}@bench>\r\nList-Id: <news.example.org>\r\n\r\n")
+    return head.encode() + b"x" * size
+
+def run(strategy, caps, messages, size, latency):
+    # model a server that marks copies read, which is what keep-unread is for
+    server = FakeIMAPServer(latency=latency, capabilities=caps, seen_on_copy=True).start()
+    try:
+        inbox = server.store.mailbox("INBOX")
+        for i in range(messages):
+            # every third message already read, the rest unread
+            inbox.add(make_message(i, size), ["\\Seen"] if i % 3 == 0 else [])
+        imap = imaplib.IMAP4("127.0.0.1", server.port)
+        imap.login("bench", "bench")
+        server_caps = capabilities(imap)
+        select_mailbox(imap, "INBOX")
+        start = (server.store.commands, server.store.bytes_in, server.store.bytes_out, time.perf_counter())
+
+        uids = imap.uid("SEARCH", None, "ALL")[1][0].split()
+        plan = ActionPlan(strategy)
+        for rec in fetch_batched(imap, uids, "(FLAGS)"):
+            plan.add(rec["uid"], "move", "Newsletters", flags=rec["flags"])
+        plan.execute(imap, server_caps, "INBOX")
+        imap.expunge()
+
+        elapsed = time.perf_counter() - start[3]
+        dest = server.store.mailbox("Newsletters")
+        unread = sum(1 for m in dest.messages.values() if "\\Seen" not in m.flags)
+        imap.logout()
+        return {
+            "commands": server.store.commands - start[0],
+            "bytes_up": server.store.bytes_in - start[1],
+            "bytes_down": server.store.bytes_out - start[2],
+            "seconds": elapsed,
+            "unread_kept": unread,
+        }
+    finally:
+        server.stop()
+
+def main():
+    ap = argparse.ArgumentParser(description="Compare MOVE_STRATEGY costs against a local fake IMAP server")
+    ap.add_argument("--messages", type=int, default=200)
+    ap.add_argument("--size", type=int, default=100_000, help="body bytes per message")
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds per command")
+    args = ap.parse_args()
+
+    expected_unread = sum(1 for i in range(args.messages) if i % 3)
+    print(f"{args.messages} messages x {args.size} bytes, {expected_unread} unread; server marks copies read")
+    print(f"{'strategy':<12} {'server caps':<24} {'cmds':>6} {'up':>12} {'down':>12} {'secs':>7} {'unread':>7}")
+    for caps in ("IMAP4rev1 UIDPLUS MOVE", "IMAP4rev1 UIDPLUS", "IMAP4rev1"):
+        for strategy in ActionPlan.STRATEGIES:
+            r = run(strategy, caps, args.messages, args.size, args.latency)
+            print(f"{strategy:<12} {caps:<24} {r['commands']:>6} {r['bytes_up']:>12,} "
+                  f"{r['bytes_down']:>12,} {r['seconds']:>7.2f} {r['unread_kept']:>7}")
+
+if __name__ == "__main__":
+    main()
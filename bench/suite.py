@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of filer.main() and train_rules.main() against the
+# local fake IMAP and SMTP servers, with results tracked across commits.
+#
+#   python3 bench/suite.py                          # 10k messages
+#   python3 bench/suite.py --messages 10000 100000 --latency 0.02
+#   FETCH_CHUNK=1000 python3 bench/suite.py --attachment-every 20 --attachment-size 2000000
+#
+# Each size gets a fresh synthetic INBOX and runs, in order:
+#   filer-cold    first run: full scan of INBOX
+#   filer-warm    second run: nothing new since the checkpoint
+#   filer-rescan  the rules file was edited: full scan again (header cache warm)
+#   trainer       Train/* folders, half copies of INBOX mail and half new
+# The scripts run in a child process (HOME is a temp dir, so nothing of yours
+# is touched) and are timed around main(). Round trips and bytes are counted
+# by the fake server, peak RSS by the child. Results are appended to
+# bench/results.jsonl with the git revision and compared with the last run
+# of the same scenario at another revision.
+import argparse, datetime, json, os, random, resource, shutil, subprocess, sys, tempfile, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+from fakeimap import FakeIMAPServer
+from fakesmtp import FakeSMTPServer
+
+RESULTS = os.path.join(HERE, "results.jsonl")
+
+# Tuning variables recorded with each result, since they change the numbers
+TUNING = ("FILER_FETCH", "FETCH_CHUNK", "IMAP_WORKERS", "FILER_PARSE_PROCS", "MOVE_STRATEGY",
+          "HEADER_CACHE_SIZE", "SMTP_SESSIONS")
+
+LISTS, SHOPS, OFFERS = 50, 40, 30
+
+# --- synthetic mail -------------------------------------------------------
+def attachment(size):
+    line = b"QUJDREVGR0hJSktMTU5PUFFSU1RVVldYWVphYmNkZWZnaGlqa2xtbm9wcXJzdHV2d3h5ejAx\r\n"
+    return line * (size // len(line) + 1)
+
+def make_message(i, rng, attach_every=0, attach_size=0, tag="m"):
+    """One message with a header shape picked by i; bodies are small unless attached."""
+    kind = i % 10
+    headers = [f"Message-ID: <{tag}{i}@bench.example>", f"Date: Mon, 1 Jan 2024 00:00:{i % 60:02d} +0000"]
+    if kind < 3:
+        n = rng.randrange(LISTS)
+        headers += [f"From: Newsletter {n} <news@list{n}.example.org>",
+                    f"Subject: Issue {i} of the list{n} digest",
+                    f"List-Id: List {n} <list{n}.example.org>",
+                    f"List-Unsubscribe: <https://unsub.list{n}.example.org/u?id={i}>,\r\n <mailto:unsub@list{n}.example.org>"]
+    elif kind < 5:
+        n = rng.randrange(OFFERS)
+        headers += [f"From: deals@mailer{n}.example.net",
+                    f"Subject: =?utf-8?b?U2FsZSBlbmRzIHNvb24h?= {i}",
+                    f"List-Unsubscribe: <mailto:leave-{i}@offers{n}.example.com>"]
+    elif kind < 7:
+        n = rng.randrange(SHOPS)
+        headers += [f"From: \"Shop {n}\" <orders@shop{n}.example.com>",
+                    f"Subject: Your order #{i} has shipped"]
+    elif kind == 7 and i % 50 == 7:
+        headers += ["From: bookings@airline.example", f"Subject: Your itinerary {i}"]
+    elif kind == 8:
+        headers += [f"From: =?iso-8859-1?q?J=F6rg_{i % 97}?= <jorg{i % 97}@people.example>",
+                    f"Subject: Re: a rather long subject line that the client folded\r\n over two lines ({i})"]
+    else:
+        headers += [f"From: friend{rng.randrange(1000)}@mail{i % 13}.example", f"Subject: hello {i}"]
+
+    if attach_every and i % attach_every == 0:
+        headers += ["MIME-Version: 1.0", "Content-Type: multipart/mixed; boundary=\"b\""]
+        body = (b"--b\r\nContent-Type: text/plain\r\n\r\nsee attached\r\n"
+                b"--b\r\nContent-Type: application/pdf\r\nContent-Transfer-Encoding: base64\r\n"
+                b"Content-Disposition: attachment; filename=\"doc.pdf\"\r\n\r\n"
+                + attachment(attach_size) + b"--b--\r\n")
+    else:
+        body = b"Just a short body.\r\n"
+    return "\r\n".join(headers).encode() + b"\r\n\r\n" + body
+
+def make_rules(extra):
+    rules = [{"match": {"header": "List-Id", "contains": f"list{n}.example.org"},
+              "actions": [{"move": "Newsletters"}]} for n in range(0, LISTS, 2)]
+    rules += [{"match": {"header": "List-Unsubscribe", "contains": f"offers{n}.example.com"},
+               "actions": ["mark_read", {"move": "Offers"}]} for n in range(OFFERS)]
+    rules += [{"match": {"header": "From", "contains": f"shop{n}.example.com"},
+               "actions": ["mark_read", {"move": "Receipts"}]} for n in range(0, SHOPS, 2)]
+    rules.append({"match": {"header": "From", "contains": "airline.example"},
+                  "actions": [{"forward": "plans@tripit.example"}, {"move": "Travel/Flight Tickets"}, "mark_read"]})
+    # rules that never match, to size the matcher like a long-trained ruleset
+    rules += [{"match": {"header": "From", "contains": f"unused{n}.example.net"},
+               "actions": [{"move": "Archive"}]} for n in range(extra)]
+    return rules
+
+def write_rules(home, rules):
+    import yaml
+    with open(os.path.join(home, ".imap-rules.yaml"), "w") as f:
+        yaml.safe_dump({"rules": rules}, f, sort_keys=False)
+
+# --- running --------------------------------------------------------------
+def child(script):
+    """Run one script's main() in this process and report time and peak RSS."""
+    sys.argv = [script]
+    module = __import__(script)
+    start = time.perf_counter()
+    module.main()
+    seconds = time.perf_counter() - start
+    print(json.dumps({"seconds": seconds, "peak_rss_mb": round(peak_rss_mb(), 1)}))
+
+def peak_rss_mb():
+    # On Linux ru_maxrss carries over the parent's peak through fork/exec, and
+    # the parent holds the whole fake mailbox; VmHWM is this process's own.
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def run_script(script, env, imap, smtp):
+    before = (imap.store.commands, imap.store.bytes_in, imap.store.bytes_out,
+              smtp.counters.messages, smtp.counters.logins)
+    wall = time.perf_counter()
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", script],
+                          env=env, cwd=ROOT, capture_output=True, text=True)
+    wall = time.perf_counter() - wall
+    if proc.returncode != 0 or not proc.stdout.strip():
+        sys.stderr.write(proc.stderr[-4000:])
+        raise SystemExit(f"{script} failed with exit code {proc.returncode}")
+    metrics = json.loads(proc.stdout.strip().splitlines()[-1])
+    errors = sum(1 for line in proc.stderr.splitlines() if " - ERROR - " in line)
+    metrics.update({
+        "wall_seconds": round(wall, 3),
+        "seconds": round(metrics["seconds"], 3),
+        "round_trips": imap.store.commands - before[0],
+        "bytes_up": imap.store.bytes_in - before[1],
+        "bytes_down": imap.store.bytes_out - before[2],
+        "forwards": smtp.counters.messages - before[3],
+        "smtp_logins": smtp.counters.logins - before[4],
+        "errors": errors,
+    })
+    return metrics
+
+def session(args, messages):
+    """All scenarios for one mailbox size; yields (scenario, metrics)."""
+    rng = random.Random(args.seed)
+    imap = FakeIMAPServer(latency=args.latency).start()
+    smtp = FakeSMTPServer().start()
+    home = tempfile.mkdtemp(prefix="imap-bench-")
+    try:
+        inbox = imap.store.mailbox("INBOX")
+        for i in range(messages):
+            inbox.add(make_message(i, rng, args.attachment_every, args.attachment_size),
+                      ["\\Seen"] if i % 4 == 0 else [])
+        rules = make_rules(args.extra_rules)
+        write_rules(home, rules)
+
+        env = dict(os.environ, HOME=home, IMAP_HOST="127.0.0.1", IMAP_PORT=str(imap.port), IMAP_SSL="0",
+                   IMAP_USER="bench", IMAP_PASS="bench", SMTP_HOST="127.0.0.1", SMTP_PORT=str(smtp.port),
+                   SMTP_SSL="0", PYTHONPATH=ROOT)
+
+        yield "filer-cold", run_script("filer", env, imap, smtp)
+        yield "filer-warm", run_script("filer", env, imap, smtp)
+
+        # an edited ruleset invalidates the checkpoint and forces a full scan
+        time.sleep(0.01)
+        write_rules(home, rules + [{"match": {"header": "Subject", "contains": "never seen"}, "actions": ["delete"]}])
+        yield "filer-rescan", run_script("filer", env, imap, smtp)
+
+        # training: copies of mail still in INBOX (as if moved there) plus new mail
+        left = list(inbox.messages.values())
+        count = max(1, messages // args.train_fraction)
+        for n, folder in enumerate(("Train/Newsletters", "Train/Receipts", "Train/Travel")):
+            for i in range(count // 3):
+                if i % 2 == 0 and left:
+                    raw = left[(i * 7 + n) % len(left)].raw
+                else:
+                    raw = make_message(messages + i, rng, tag=f"t{n}-")
+                imap.store.deliver(folder, raw)
+        yield "trainer", run_script("train_rules", env, imap, smtp)
+    finally:
+        imap.stop()
+        smtp.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+def git_revision():
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                               capture_output=True, text=True).stdout.strip()
+        return rev + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def previous(path, scenario, params, rev):
+    """The latest recorded metrics for the same scenario and parameters at another revision."""
+    last = None
+    try:
+        with open(path) as f:
+            for line in f:
+                rec = json.loads(line)
+                if rec["scenario"] == scenario and rec["params"] == params and rec["rev"] != rev:
+                    last = rec
+    except FileNotFoundError:
+        pass
+    return last
+
+def change(now, then):
+    if not then:
+        return ""
+    return f"{(now - then) / then * 100:+.0f}%"
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark filer.py and train_rules.py against local fake servers")
+    ap.add_argument("--messages", type=int, nargs="+", default=[10_000], help="INBOX sizes to run")
+    ap.add_argument("--latency", type=float, default=0.0, help="seconds added to every IMAP command")
+    ap.add_argument("--attachment-every", type=int, default=50, help="every Nth message gets an attachment (0: none)")
+    ap.add_argument("--attachment-size", type=int, default=500_000, help="attachment bytes")
+    ap.add_argument("--extra-rules", type=int, default=1000, help="never-matching rules added to the ruleset")
+    ap.add_argument("--train-fraction", type=int, default=20, help="train on INBOX size / N messages")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--output", default=RESULTS, help="results file (JSON lines)")
+    ap.add_argument("--no-record", action="store_true", help="print results without appending them")
+    ap.add_argument("--child", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        return child(args.child)
+
+    rev = git_revision()
+    tuning = {k: os.environ[k] for k in TUNING if k in os.environ}
+    print(f"revision {rev}, latency {args.latency}s, {args.extra_rules} extra rules"
+          + (f", {tuning}" if tuning else ""))
+    print(f"{'messages':>9} {'scenario':<13} {'secs':>8} {'vs last':>8} {'trips':>7} {'up':>11} "
+          f"{'down':>13} {'rss MB':>7} {'fwd':>4} {'err':>4}")
+    for messages in args.messages:
+        params = {"messages": messages, "latency": args.latency, "attachment_every": args.attachment_every,
+                  "attachment_size": args.attachment_size, "extra_rules": args.extra_rules,
+                  "train_fraction": args.train_fraction, "seed": args.seed, "tuning": tuning}
+        for scenario, m in session(args, messages):
+            last = previous(args.output, scenario, params, rev)
+            print(f"{messages:>9} {scenario:<13} {m['seconds']:>8.2f} "
+                  f"{change(m['seconds'], last['metrics']['seconds'] if last else None):>8} "
+                  f"{m['round_trips']:>7} {m['bytes_up']:>11,} {m['bytes_down']:>13,} "
+                  f"{m['peak_rss_mb']:>7.1f} {m['forwards']:>4} {m['errors']:>4}", flush=True)
+            if not args.no_record:
+                with open(args.output, "a") as f:
+                    f.write(json.dumps({"rev": rev, "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                                        "scenario": scenario, "params": params, "metrics": m}) + "\n")
+
+if __name__ == "__main__":
+    main()
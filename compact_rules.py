@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# ~/bin/compact_rules.py
+# Find rules that cost a scan step but never decide where mail goes:
+#
+#   shadowed  an earlier rule matches every message this one would (e.g.
+#             From~example.com before From~news.example.com), so under
+#             first-match-wins it is never reached
+#   subsumed  this rule is reached, but without it its mail would fall
+#             through to a later rule with the same actions anyway
+#   dead      no hits in the last --dead-after filing passes (the filer
+#             records hits per rule in the rule store after every pass)
+#
+#   python3 ~/bin/compact_rules.py                 # report only
+#   python3 ~/bin/compact_rules.py --prune         # drop shadowed and subsumed rules
+#   python3 ~/bin/compact_rules.py --prune-dead    # ... and dead ones
+#
+# Dropping shadowed and subsumed rules never changes where a message is filed;
+# dropping dead rules does for any future mail they would have matched.
+import argparse, datetime, logging, os, sys
+from matcher import RULE_HEADERS
+from replay import describe, outcome
+from rulestore import RULES_DB, RULES_FILE, RuleStore, match_key
+
+DEAD_AFTER = 200
+
+# Headers whose text is part of the "any" match, so an "any" needle found in
+# them is found in "any" too
+ANY_PARTS = {"from", "subject", "list-id"}
+
+def normalized(rule):
+    """(header, needle) as RuleMatcher compiles it, or None if it skips the rule."""
+    m = rule.get("match") if isinstance(rule, dict) else None
+    if not isinstance(m, dict) or m.get("contains") is None:
+        return None
+    hdr = str(m.get("header", "")).lower()
+    return (hdr, str(m["contains"]).lower()) if hdr in RULE_HEADERS else None
+
+def covers(general, specific):
+    """True if every message that matches specific also matches general."""
+    (g_hdr, g_needle), (s_hdr, s_needle) = general, specific
+    if g_hdr != s_hdr and not (g_hdr == "any" and s_hdr in ANY_PARTS):
+        return False
+    # a header containing s_needle contains every substring of it
+    return g_needle in s_needle
+
+def analyse(rules):
+    """Return {index: (kind, other index)} for rules that never decide an outcome.
+
+    kind is "shadowed" (other is the earlier rule that always wins),
+    "subsumed" (other is the later rule that would file its mail the same)
+    or "unsupported" (other is None).
+    """
+    keys = [normalized(r) for r in rules]
+    found = {}
+    live = []  # rules that can be reached, in order
+    for j, key in enumerate(keys):
+        if key is None:
+            found[j] = ("unsupported", None)
+            continue
+        by = next((i for i in live if covers(keys[i], key)), None)
+        if by is None:
+            live.append(j)
+        else:
+            found[j] = ("shadowed", by)
+    outcomes = [outcome(r) for r in rules]
+    for pos, j in enumerate(live):
+        # mail that skips j is taken by the next reachable rule that matches
+        # it; that is safe as long as every rule up to the covering one files
+        # it the same way
+        for i in live[pos + 1:]:
+            if outcomes[i] != outcomes[j]:
+                break
+            if covers(keys[i], keys[j]):
+                found[j] = ("subsumed", i)
+                break
+    return found
+
+def dead_rules(rules, stats, redundant, dead_after):
+    """{index: (hits, passes since the last hit, last hit)} for rules idle that long.
+
+    A subsumed rule takes the hits of the rule that covers it, so its stats
+    count towards that rule (which is what would file its mail without it).
+    """
+    merged = {}
+    for idx, rule in enumerate(rules):
+        stat = stats.get(match_key(rule))
+        if stat is None or redundant.get(idx, ("",))[0] in ("shadowed", "unsupported"):
+            continue
+        target = idx
+        while redundant.get(target, ("",))[0] == "subsumed":
+            target = redundant[target][1]
+        if target in merged:
+            hits, idle, last = merged[target]
+            stat = (hits + stat[0], min(idle, stat[1]), max(last or 0, stat[2] or 0) or None)
+        merged[target] = stat
+    return {idx: stat for idx, stat in sorted(merged.items()) if stat[1] >= dead_after}
+
+def when(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime("%Y-%m-%d") if ts else "never"
+
+def main():
+    ap = argparse.ArgumentParser(description="Report or remove redundant and unused filing rules")
+    ap.add_argument("--db", default=RULES_DB, help="rule store (default: %(default)s)")
+    ap.add_argument("--rules", default=RULES_FILE, help="rules YAML kept in sync with it (default: %(default)s)")
+    ap.add_argument("--dead-after", type=int, default=DEAD_AFTER, metavar="N",
+                    help="call a rule dead after N filing passes without a hit (default: %(default)s)")
+    prune = ap.add_mutually_exclusive_group()
+    prune.add_argument("--prune", action="store_true", help="remove shadowed and subsumed rules")
+    prune.add_argument("--prune-dead", action="store_true", help="remove dead rules as well")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+
+    store = RuleStore(os.path.expanduser(args.db), os.path.expanduser(args.rules))
+    try:
+        store.sync()
+        rules = store.rules()
+        if not rules:
+            print(f"No rules in {store.path}")
+            return 1
+        redundant = analyse(rules)
+        dead = dead_rules(rules, store.hit_stats(), redundant, args.dead_after)
+
+        for kind, title in (("shadowed", "Shadowed (an earlier rule always matches first)"),
+                            ("subsumed", "Subsumed (a later rule files the same mail the same way)"),
+                            ("unsupported", "Unsupported (the filer skips these; fix or remove by hand)")):
+            found = [(idx, other) for idx, (k, other) in sorted(redundant.items()) if k == kind]
+            if found:
+                print(f"{title}:")
+                for idx, other in found:
+                    by = "" if other is None else f"\n      by {describe(other, rules[other])}"
+                    print(f"  {describe(idx, rules[idx])}{by}")
+        if dead:
+            print(f"Dead (no hits in the last {args.dead_after} filing passes):")
+            for idx, (hits, idle, last) in sorted(dead.items()):
+                print(f"  {describe(idx, rules[idx])}: {hits} hits, last {when(last)}")
+
+        drop = [idx for idx, (kind, _) in redundant.items() if kind != "unsupported"]
+        if args.prune_dead:
+            drop += list(dead)
+        counts = {kind: sum(1 for k, _ in redundant.values() if k == kind)
+                  for kind in ("shadowed", "subsumed", "unsupported")}
+        print(f"\n{len(rules)} rules: {counts['shadowed']} shadowed, {counts['subsumed']} subsumed, "
+              f"{len(dead)} dead, {counts['unsupported']} unsupported")
+        if (args.prune or args.prune_dead) and drop:
+            store.remove(sorted(drop))
+            store.save()
+            print(f"Removed {len(drop)} rules; {len(rules) - len(drop)} left")
+        elif drop or dead:
+            print("Nothing changed; --prune removes shadowed and subsumed rules, --prune-dead dead ones too")
+    finally:
+        store.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,241 +1,478 @@
 #!/usr/bin/env python3
 # ~/bin/filer.py
-import imaplib, email, os, re, ssl, yaml, logging
-from urllib.parse import urlparse
-from email.parser import BytesParser
-from email.policy import default
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(os.path.expanduser("~/.imap-filer.log"))
-    ]
-)
+import asyncio, atexit, collections, concurrent.futures, imaplib, multiprocessing, os, sys, logging, json, hashlib, tempfile, time
+import logsetup, metrics
+from mailio import (ActionPlan, FETCH_CHUNK, WORKERS, capabilities, idle_wait, noop_wait,
+                    parse_action, select_mailbox)
+from asyncmail import Account
+from rulestore import RULES_DB, RULES_FILE, RuleStore, match_key
+from matcher import RuleMatcher
+from headercache import FEATURE_FETCH, HEADER_CACHE, HeaderCache, parse_features
+
 logger = logging.getLogger(__name__)
 
+LOG_FILE = "~/.imap-filer.log"
+
 IMAP_HOST = os.getenv("IMAP_HOST", "imap.mailbox.org")
 IMAP_USER = os.getenv("IMAP_USER")
 IMAP_PASS = os.getenv("IMAP_PASS")
 
-RULES_FILE = os.path.expanduser("~/.imap-rules.yaml")
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.mailbox.org")
+SMTP_USER = os.getenv("SMTP_USER", IMAP_USER)
+SMTP_PASS = os.getenv("SMTP_PASS", IMAP_PASS)
+
+# Forwards wait here until the SMTP server accepts them
+SPOOL_DIR = os.path.expanduser(os.getenv("FILER_SPOOL", "~/.imap-filer-spool"))
+
+# Per-mailbox checkpoint (UIDVALIDITY, last processed UID, HIGHESTMODSEQ) so
+# later runs only look at new mail. FILER_FULL_SCAN=1 ignores it for one run.
+STATE_FILE = os.path.expanduser(os.getenv("FILER_STATE", "~/.imap-filer-state.json"))
+FULL_SCAN = os.getenv("FILER_FULL_SCAN", "") == "1"
+
+# "headers" fetches only the header fields the rules look at and downloads the
+# full message lazily when an action needs it; "full" fetches BODY.PEEK[] up front.
+FETCH_MODE = os.getenv("FILER_FETCH", "headers").lower()
+
+# Backfills (more than FETCH_CHUNK messages) can have their headers decoded in
+# this many worker processes while the download continues; worth it with
+# FILER_FETCH=full on a machine with spare cores. 0 decodes in the filer itself.
+PARSE_PROCS = int(os.getenv("FILER_PARSE_PROCS", "0"))
+
+# Per-phase timings, IMAP command counts/bytes and rule hits, rewritten after
+# every run: JSON, or a Prometheus textfile if the name ends in .prom ("" = off).
+# FILER_PROFILE=path also writes a cProfile dump of the run there.
+METRICS_FILE = os.path.expanduser(os.getenv("FILER_METRICS", "~/.imap-filer-metrics.json"))
+PROFILE_FILE = os.path.expanduser(os.getenv("FILER_PROFILE", ""))
+
+# Watch mode (filer.py --watch): IDLE is re-issued this often because servers
+# drop idle clients after ~30 minutes; without IDLE the mailbox is polled with
+# NOOP every FILER_POLL_INTERVAL seconds. Reconnects back off up to 5 minutes.
+IDLE_TIMEOUT = int(os.getenv("FILER_IDLE_TIMEOUT", "600"))
+POLL_INTERVAL = int(os.getenv("FILER_POLL_INTERVAL", "60"))
+MAX_RECONNECT_DELAY = 300
+
+# Seconds record_hits() waits for a busy rule store (a trainer saving,
+# compact_rules.py) before giving up on that pass's hit counts
+RECORD_HITS_TIMEOUT = 2
 
-def load_rules():
+_parse_pool = None
+
+def parse_pool():
+    """The process pool for backfill parsing, started on first use; None if off."""
+    global _parse_pool
+    if PARSE_PROCS < 1:
+        return None
+    if _parse_pool is None:
+        # spawn rather than fork: the logging and IMAP threads are running already
+        _parse_pool = concurrent.futures.ProcessPoolExecutor(
+            PARSE_PROCS, mp_context=multiprocessing.get_context("spawn"))
+        atexit.register(_parse_pool.shutdown)
+    return _parse_pool
+
+def default_account():
+    """The single account configured by IMAP_USER etc."""
+    return Account("", IMAP_HOST, IMAP_USER, IMAP_PASS, SMTP_HOST, SMTP_USER, SMTP_PASS,
+                   SPOOL_DIR, RULES_FILE, RULES_DB, STATE_FILE, HEADER_CACHE)
+
+def load_rules(account):
     try:
-        with open(RULES_FILE) as f:
-            rules = yaml.safe_load(f).get("rules", [])
-        logger.info(f"Loaded {len(rules)} rules from {RULES_FILE}")
-        for i, rule in enumerate(rules, 1):
-            logger.debug(f"  Rule {i}: {rule.get('match', {})}")
+        with metrics.span("load_rules"):
+            store = RuleStore(account.rules_db, account.rules_file)
+            try:
+                store.sync()
+                rules = store.rules()
+            finally:
+                store.close()
+        logger.info("Loaded %d rules from %s", len(rules), store.path)
+        if logger.isEnabledFor(logging.DEBUG):
+            for i, rule in enumerate(rules, 1):
+                logger.debug("  Rule %d: %s", i, rule.get("match", {}))
+        if not rules:
+            logger.error("No rules found; add some to %s or run the trainer", account.rules_file)
         return rules
-    except FileNotFoundError:
-        logger.error(f"Rules file not found: {RULES_FILE}")
-        return []
     except Exception as e:
-        logger.error(f"Error loading rules: {e}")
+        logger.error("Error loading rules: %s", e)
         return []
 
-def h(msg, name):
-    from email.header import decode_header, make_header
-    raw = msg.get(name, "")
-    try: return str(make_header(decode_header(raw)))
-    except Exception: return raw
-
-def list_unsub_domains(msg):
-    lu = msg.get("List-Unsubscribe", "")
-    if not lu: return []
-    parts = re.findall(r"<([^>]+)>", lu) or [p.strip() for p in lu.split(",")]
-    out = []
-    for p in parts:
-        p = p.strip("<> ").lower()
-        if p.startswith("http"):
-            host = urlparse(p).hostname
-            if host: out.append(host)
-        elif p.startswith("mailto:") and "@" in p:
-            out.append(p.split("@")[-1])
-    return out
-
-def match_rule(msg, rule):
-    m = rule["match"]; hdr = m["header"].lower(); needle = m["contains"].lower()
-    if hdr == "list-id":
-        lid = h(msg,"List-Id").lower()
-        result = needle in lid
-        logger.debug(f"  Checking List-Id: '{needle}' in '{lid[:60]}...' → {result}")
-        return result
-    if hdr == "list-unsubscribe":
-        domains = list_unsub_domains(msg)
-        result = any(needle in d for d in domains)
-        logger.debug(f"  Checking List-Unsubscribe: '{needle}' in {domains} → {result}")
-        return result
-    if hdr == "from":
-        frm = h(msg,"From").lower()
-        result = needle in frm
-        logger.debug(f"  Checking From: '{needle}' in '{frm[:60]}...' → {result}")
-        return result
-    if hdr == "subject":
-        subj = h(msg,"Subject").lower()
-        result = needle in subj
-        logger.debug(f"  Checking Subject: '{needle}' in '{subj[:60]}...' → {result}")
-        return result
-    if hdr == "any":
-        # last-resort catch-all; not usually needed
-        combined = (h(msg,"From")+" "+h(msg,"Subject")+" "+h(msg,"List-Id")).lower()
-        result = needle in combined
-        logger.debug(f"  Checking any: '{needle}' in combined headers → {result}")
-        return result
-    return False
-
-def ensure_mailbox(imap, name):
+def record_hits(account, rules, hits):
+    """Add one pass's hits per rule index to the rule store (see compact_rules.py)."""
+    counts = collections.Counter()
+    for idx, n in hits.items():
+        counts[match_key(rules[idx])] += n
     try:
-        imap.create(name)
-        logger.debug(f"Created mailbox: {name}")
-    except imaplib.IMAP4.error as e:
-        # Folder likely already exists; that's fine
-        logger.debug(f"Mailbox {name} creation info: {e}")
-
-def send_forward(raw_bytes, to_addr):
-    import smtplib
-    from email.message import EmailMessage
-    smtp_host = os.getenv("SMTP_HOST", "smtp.mailbox.org")
-    smtp_user = os.getenv("SMTP_USER", IMAP_USER)
-    smtp_pass = os.getenv("SMTP_PASS", IMAP_PASS)
+        store = RuleStore(account.rules_db, account.rules_file, timeout=RECORD_HITS_TIMEOUT)
+        try:
+            store.record_hits(counts)
+        finally:
+            store.close()
+    except Exception as e:
+        logger.warning("Could not record rule hits: %s", e)
+
+def load_state(path=STATE_FILE):
     try:
-        msg = EmailMessage()
-        msg["From"] = smtp_user
-        msg["To"] = to_addr
-        msg["Subject"] = "Fwd: travel docs"
-        msg.set_content("Forwarded itinerary/booking.")
-        msg.add_attachment(raw_bytes, maintype="message", subtype="rfc822", filename="message.eml")
-        with smtplib.SMTP_SSL(smtp_host, 465) as s:
-            s.login(smtp_user, smtp_pass)
-            s.send_message(msg)
-        logger.info(f"Forwarded message to {to_addr}")
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
     except Exception as e:
-        logger.error(f"Failed to forward message to {to_addr}: {e}")
-
-def do_action(imap, uid, raw, action):
-    # allow several shapes
-    if isinstance(action, str):
-        name, arg = action, None
-    elif isinstance(action, dict):
-        name, arg = next(iter(action.items()))
-    elif isinstance(action, (list, tuple)):
-        # e.g. ['move', 'Offers'] or ['mark_read', None]
-        if len(action) == 0:
-            return
-        name = action[0]
-        arg = action[1] if len(action) > 1 else None
-    else:
-        logger.warning(f"Unknown action shape for UID {uid}: {action}")
-        return  # unknown shape; skip safely
+        logger.warning("Ignoring unreadable state file %s: %s", path, e)
+        return {}
 
+def save_state(state, path=STATE_FILE):
     try:
-        if name == "mark_read":
-            imap.uid("STORE", uid, "+FLAGS", r"(\Seen)")
-            logger.info(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Marked as read")
-        elif name == "move":
-            dest = arg
-            ensure_mailbox(imap, dest)
-            # Use APPEND with the original raw message so the copy in the
-            # destination mailbox remains unread. Some servers mark copied
-            # messages as \Seen; APPEND lets us control flags on the new
-            # message. If APPEND fails, fall back to COPY.
-            try:
-                if raw is not None:
-                    # append(message) expects bytes; no flags => stays unseen
-                    imap.append(dest, None, None, raw)
-                    logger.info(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Appended to {dest} (kept unread)")
-                else:
-                    # if we don't have raw data, fall back to COPY
-                    imap.uid("COPY", uid, dest)
-                    logger.info(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Copied to {dest} (no raw available)")
-            except Exception as e:
-                logger.debug(f"APPEND to {dest} failed: {e}; falling back to COPY")
-                try:
-                    imap.uid("COPY", uid, dest)
-                    logger.info(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Copied to {dest}")
-                except Exception as e2:
-                    logger.error(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Failed to copy to {dest}: {e2}")
-            # mark original for deletion (move semantics)
-            imap.uid("STORE", uid, "+FLAGS", r"(\Deleted)")
-        elif name == "forward":
-            if raw is None:
-                typ, d = imap.uid("FETCH", uid, "(BODY.PEEK[])")  # full message without setting \Seen
-                raw = d[0][1] if d and d[0] else b""
-            send_forward(raw, arg)
-        elif name == "delete":
-            imap.uid("STORE", uid, "+FLAGS", r"(\Deleted)")
-            logger.info(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Marked for deletion")
-        else:
-            logger.warning(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Unknown action: {name}")
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".imap-filer-state.")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp, path)
     except Exception as e:
-        logger.error(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Error performing action '{name}': {e}")
+        logger.error("Error saving state: %s", e)
+
+def rules_fingerprint(rules):
+    # a changed ruleset may match mail that was skipped before, so it forces a rescan
+    return hashlib.sha1(json.dumps(rules, sort_keys=True, default=str).encode()).hexdigest()
+
+def search_since(imap, mailbox, info, checkpoint, fingerprint):
+    """Return (uids, reason) for the messages that still need processing."""
+    if FULL_SCAN:
+        reason = "full scan requested"
+    elif not checkpoint:
+        reason = "no checkpoint"
+    elif checkpoint.get("uidvalidity") != info["uidvalidity"] or info["uidvalidity"] is None:
+        reason = f"UIDVALIDITY changed ({checkpoint.get('uidvalidity')} -> {info['uidvalidity']})"
+    elif checkpoint.get("rules") != fingerprint:
+        reason = "rules changed"
+    else:
+        last = checkpoint.get("last_uid", 0)
+        if info["uidnext"] is not None and info["uidnext"] <= last + 1:
+            return [], f"no new mail in {mailbox} (UIDNEXT {info['uidnext']})"
+        if info["highestmodseq"] is not None and info["highestmodseq"] == checkpoint.get("highestmodseq"):
+            return [], f"{mailbox} unchanged (HIGHESTMODSEQ {info['highestmodseq']})"
+        typ, data = imap.uid("SEARCH", None, f"UID {last + 1}:*")
+        uids = data[0].split() if typ == "OK" and data and data[0] else []
+        # "n:*" always matches the highest UID, even when it is below n
+        return [u for u in uids if int(u) > last], f"incremental from UID {last + 1}"
+    # Process ALL (seen/unseen) so backfill works; moving out prevents duplicates.
+    typ, data = imap.uid("SEARCH", None, "ALL")
+    return (data[0].split() if typ == "OK" and data and data[0] else []), reason
+
+def fetch_spec():
+    # FLAGS tells the action plan which messages were unread before we touched them.
+    # Headers mode fetches every header the features are built from, whatever
+    # the current rules use, so cached features stay valid when rules change.
+    if FETCH_MODE == "full":
+        return "(FLAGS BODY.PEEK[])"
+    return f"(FLAGS {FEATURE_FETCH})"
+
+def needs_body(actions):
+    # only forward needs the original; moves are done server-side
+    return any(parse_action(a)[0] == "forward" for a in actions)
+
+def fetch_body(imap, uid):
+    typ, d = imap.uid("FETCH", uid, "(BODY.PEEK[])")  # full message without setting \Seen
+    if typ != "OK" or not d or not isinstance(d[0], tuple):
+        return None
+    return d[0][1]
+
+def match_features(uid, features, matcher):
+    """First rule matching a message's features: (rule index, rule) or (None, None)."""
+    start = time.perf_counter()
+    rule_idx, rule = matcher.match(features)  # first-match wins
+    metrics.add_time("phase", time.perf_counter() - start, phase="match")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("UID %s: From=%.50s, Subject=%.50s -> %s", int(uid), features["from"], features["subject"],
+                     "no match" if rule is None else f"rule {rule_idx + 1}")
+    if rule is not None:
+        m = rule.get("match", {})
+        metrics.count("rule_hits", rule=rule_idx + 1, header=m.get("header"), contains=m.get("contains"))
+    return rule_idx, rule
+
+def classify(rec, matcher, keep_raw=False, cache=None):
+    """Decode one fetched message and find the first rule it matches.
+
+    Returns (uid, rule index, flags, raw) for a match and None otherwise. raw
+    is only kept when keep_raw is set (FILER_FETCH=full). The decoded
+    features are stored in cache (a MailboxCache) when one is given.
+    Records fetched with a parse pool arrive already decoded.
+    """
+    uid, data = rec["uid"], rec["data"]
+    if data is None:
+        logger.debug("Skipping UID %s: fetch failed", int(uid))
+        return None
+
+    if "parsed" in rec:
+        features = rec["parsed"]
+    else:
+        start = time.perf_counter()
+        features = parse_features(data)
+        metrics.add_time("phase", time.perf_counter() - start, phase="parse")
+    if features is None:
+        logger.warning("Skipping UID %s: could not decode its headers", int(uid))
+        return None
+    if cache is not None:
+        cache.put(uid, features)
+
+    rule_idx, rule = match_features(uid, features, matcher)
+    if rule is None:
+        return None
+    return uid, rule_idx, rec["flags"], data if keep_raw else None
+
+async def apply_rule(aimap, smtp, plan, uid, rule, flags, raw):
+    # in header mode the full message is only downloaded if an action needs it
+    if raw is None and needs_body(rule["actions"]):
+        raw = await aimap.call(fetch_body, uid)
+    for a in rule["actions"]:
+        name, arg = parse_action(a)
+        metrics.count("actions", action=name)
+        if name == "forward":
+            # forwards go out in the background; mailbox changes wait for the plan
+            await smtp.forward(raw or b"", arg)
+        elif not plan.add(uid, name, arg, flags=flags):
+            logger.warning("  [UID %s] Unknown action: %s", int(uid), a)
+
+async def fetch_and_apply(account, aimap, smtp, plan, matcher, mailbox, uids, spec, cache, hits):
+    """Fetch, match and plan actions for uids, counting matches per rule index in hits.
+
+    Returns the UIDs that could not be fetched.
+    """
+    fetched = set()
+    keep_raw = FETCH_MODE == "full"  # forwards then reuse the body already fetched
+
+    def handle(rec):
+        if rec["data"] is not None:
+            fetched.add(int(rec["uid"]))
+        return classify(rec, matcher, keep_raw, cache)
+
+    matches = None
+    pool = parse_pool() if len(uids) > FETCH_CHUNK else None
+    if WORKERS > 1 and len(uids) > FETCH_CHUNK:
+        # backfill: fetch and match over several connections, act on this one
+        matches = await account.fetch_sharded(mailbox, uids, spec, handle, pool)
+    if matches is not None:
+        for uid, rule_idx, flags, raw in matches:
+            await apply_rule(aimap, smtp, plan, uid, matcher.rules[rule_idx], flags, raw)
+            hits[rule_idx] += 1
+    else:
+        async for rec in aimap.fetch(uids, spec, pool=pool):
+            match = handle(rec)
+            if match:
+                uid, rule_idx, flags, raw = match
+                await apply_rule(aimap, smtp, plan, uid, matcher.rules[rule_idx], flags, raw)
+                hits[rule_idx] += 1
+    return [u for u in uids if int(u) not in fetched]
+
+async def file_mailbox(account, aimap, smtp, caps, rules, matcher, mailbox="INBOX"):
+    """One filing pass over mailbox, from the checkpoint to the newest mail.
+
+    Selects mailbox, matches everything new since the last run, applies the
+    action plan, expunges and saves the checkpoint. Returns the number of
+    messages that matched a rule.
+    """
+    started = time.time()
+    with metrics.span("select"):
+        info = await aimap.call(select_mailbox, mailbox, condstore="CONDSTORE" in caps)
+    if info is None:
+        logger.error("Could not select %s", account.label(mailbox))
+        return 0
+    logger.debug("Selected %s (UIDVALIDITY %s, UIDNEXT %s)", mailbox, info["uidvalidity"], info["uidnext"])
+
+    state = load_state(account.state_file)
+    checkpoint = state.get(mailbox)
+    fingerprint = rules_fingerprint(rules)
+    with metrics.span("search"):
+        uids, reason = await aimap.call(search_since, mailbox, info, checkpoint, fingerprint)
+    logger.debug("Found %d messages in %s (%s)", len(uids), mailbox, reason)
+
+    plan = ActionPlan()
+    spec = fetch_spec()
+    hits = collections.Counter()  # rule index -> messages matched this pass
+    cache = HeaderCache(account.header_cache)
+    try:
+        # messages seen on an earlier run are matched from the cache; only
+        # the flags of those that match are fetched
+        seen = cache.mailbox(mailbox, info["uidvalidity"])
+        with metrics.span("cache_lookup"):
+            cached = seen.get_many(uids)
+        matched = {}
+        if cached:
+            logger.debug("Matching %d messages from the header cache", len(cached))
+            with metrics.span("cached_match"):
+                for uid, features in cached.items():
+                    rule_idx, rule = match_features(uid, features, matcher)
+                    if rule is not None:
+                        matched[uid] = rule_idx
+                async for rec in aimap.fetch(sorted(matched, key=int), "(FLAGS)"):
+                    rule_idx = matched.pop(rec["uid"])
+                    await apply_rule(aimap, smtp, plan, rec["uid"], matcher.rules[rule_idx], rec["flags"], None)
+                    hits[rule_idx] += 1
+
+        fetch = [u for u in uids if u not in cached]
+        logger.debug("Fetching %d messages with %s", len(fetch), spec)
+        with metrics.span("fetch_match"):
+            missing = await fetch_and_apply(account, aimap, smtp, plan, matcher, mailbox, fetch, spec, seen, hits)
+    finally:
+        cache.close()
+    # matches whose flags did not come back, and messages not fetched at all
+    retry = [int(u) for u in [*matched, *missing]]
+
+    if plan:
+        logger.debug("Applying actions to %d messages", len(plan))
+        with metrics.span("execute"):
+            retry += [int(u) for u in await aimap.call(plan.execute, caps, mailbox)]
+    processed = sum(hits.values())
+    with metrics.span("expunge"):
+        await aimap.call(lambda imap: imap.expunge())
+    with metrics.span("forward_drain"):
+        await smtp.drain()
+
+    last_uid = max([int(u) for u in uids], default=0)
+    if checkpoint and checkpoint.get("uidvalidity") == info["uidvalidity"]:
+        last_uid = max(last_uid, checkpoint.get("last_uid", 0))
+    if retry:
+        # stop short of the first message that still needs work, and drop
+        # HIGHESTMODSEQ so the next run searches again even if nothing changed
+        logger.warning("%s: %d messages could not be filed; retrying from UID %d next run",
+                       account.label(mailbox), len(retry), min(retry))
+        last_uid = min(last_uid, min(retry) - 1)
+    state[mailbox] = {
+        "uidvalidity": info["uidvalidity"],
+        "last_uid": last_uid,
+        "highestmodseq": None if retry else info["highestmodseq"],
+        "rules": fingerprint,
+    }
+    save_state(state, account.state_file)
+    if uids:
+        with metrics.span("record_hits"):
+            await asyncio.to_thread(record_hits, account, matcher.rules, hits)
+
+    metrics.count("messages_searched", len(uids))
+    metrics.count("messages_cached", len(cached))
+    metrics.count("messages_matched", processed)
+    # all rules are matched in one pass per header, so match time is per header
+    for hdr, (calls, seconds) in matcher.timings.items():
+        metrics.add_time("match_header", seconds, calls, header=hdr)
+    matcher.timings.clear()
+    metrics.current.finish_run(started, mailbox=account.label(mailbox), searched=len(uids), cached=len(cached),
+                               matched=processed)
+
+    # one summary per pass instead of a line per message
+    if uids:
+        logger.info("%s: %d messages (%s), %d from the header cache, %d matched in %.2fs",
+                    account.label(mailbox), len(uids), reason, len(cached), processed, time.time() - started)
+        if hits:
+            logger.info("  hits: %s", ", ".join(f"rule {idx + 1}: {n}" for idx, n in hits.most_common(10))
+                        + (f" and {len(hits) - 10} more rules" if len(hits) > 10 else ""))
+    else:
+        logger.debug("%s: nothing to do (%s)", account.label(mailbox), reason)
+    return processed
+
+async def file_account(account, aimap, smtp, caps, rules, mailboxes=("INBOX",)):
+    """File each of mailboxes in turn on one connection; returns messages matched."""
+    matcher = RuleMatcher(rules, timed=True)
+    processed = 0
+    for mailbox in mailboxes:
+        processed += await file_mailbox(account, aimap, smtp, caps, rules, matcher, mailbox)
+    return processed
+
+async def run_once(account, rules):
+    logger.info("Connecting to %s as %s", account.imap_host, account.imap_user)
+    aimap = await account.connect()
+    logger.info("Connected and authenticated")
+    try:
+        caps = await aimap.call(capabilities)
+        await file_account(account, aimap, account.smtp(), caps, rules)
+    finally:
+        await aimap.logout()
+    metrics.current.write(METRICS_FILE)
 
 def main():
     try:
+        logsetup.setup(LOG_FILE)
         logger.info("Starting filer...")
+        metrics.start("filer")
         assert IMAP_USER and IMAP_PASS, "Set IMAP_USER/IMAP_PASS"
         
-        rules = load_rules()
+        account = default_account()
+        rules = load_rules(account)
         if not rules:
             logger.warning("No rules loaded; nothing to do")
             return
-        
-        logger.info(f"Connecting to {IMAP_HOST} as {IMAP_USER}")
-        imap = imaplib.IMAP4_SSL(IMAP_HOST)
-        imap.login(IMAP_USER, IMAP_PASS)
-        logger.info("Connected and authenticated")
-        
-        imap.select('"INBOX"', readonly=False)
-        logger.info("Selected INBOX")
 
-        # Process ALL (seen/unseen) so backfill works; moving out prevents duplicates.
-        typ, data = imap.uid("SEARCH", None, "ALL")
-        uids = data[0].split() if data and data[0] else []
-        logger.info(f"Found {len(uids)} messages in INBOX")
-        
-        processed = 0
-        for uid in uids:
-            typ, d = imap.uid("FETCH", uid, "(BODY.PEEK[])")
-            if typ != "OK" or not d or not d[0]:
-                logger.debug(f"Skipping UID {uid.decode() if isinstance(uid, bytes) else uid}: fetch failed")
-                continue
-            
-            raw = d[0][1]
-            msg = email.message_from_bytes(raw)
-            subj = email.header.decode_header(msg.get("Subject", "Unknown"))[0][0]
-            if isinstance(subj, bytes):
-                subj = subj.decode('utf-8', errors='ignore')
-            frm = msg.get("From", "Unknown")
-            
-            logger.debug(f"Processing UID {uid.decode() if isinstance(uid, bytes) else uid}: From={frm[:50]}, Subject={str(subj)[:50]}")
-
-            rule_matched = False
-            for rule_idx, rule in enumerate(rules, 1):
-                logger.debug(f"  Trying rule {rule_idx}: {rule.get('match', {})}")
-                if match_rule(msg, rule):
-                    logger.info(f"UID {uid.decode() if isinstance(uid, bytes) else uid} matched rule {rule_idx}")
-                    for a in rule["actions"]:
-                        do_action(imap, uid, raw, a)
-                    rule_matched = True
-                    processed += 1
-                    break  # first-match wins
-            
-            if not rule_matched:
-                logger.debug(f"UID {uid.decode() if isinstance(uid, bytes) else uid} did not match any rule")
-
-        logger.info(f"Processed {processed} messages, expunging...")
-        imap.expunge()
-        imap.logout()
+        with metrics.profile(PROFILE_FILE):
+            asyncio.run(run_once(account, rules))
         logger.info("Filer completed successfully")
         
     except AssertionError as e:
-        logger.error(f"Configuration error: {e}")
+        logger.error("Configuration error: %s", e)
     except Exception as e:
-        logger.exception(f"Filer error: {e}")
+        logger.exception("Filer error: %s", e)
 
-if __name__ == "__main__":
-    main()
+def rules_mtime(path=RULES_FILE):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+async def watch():
+    """Daemon mode: keep one connection open and file new mail as it arrives.
+
+    Waits with IDLE (or NOOP polling when the server lacks it), reconnects
+    with backoff when the connection drops and reloads the rules whenever
+    the rules file changes on disk.
+    """
+    logsetup.setup(LOG_FILE)
+    logger.info("Starting filer in watch mode...")
+    metrics.start("filer")
+    if not (IMAP_USER and IMAP_PASS):
+        logger.error("Configuration error: Set IMAP_USER/IMAP_PASS")
+        return
 
+    account = default_account()
+    mtime = rules_mtime()
+    rules = load_rules(account)
+    matcher = RuleMatcher(rules, timed=True)
+    rules_changed = lambda: rules_mtime() != mtime
+    smtp = account.smtp()
+    delay = 0
+    while True:
+        aimap = None
+        try:
+            logger.info("Connecting to %s as %s", IMAP_HOST, IMAP_USER)
+            aimap = await account.connect()
+            caps = await aimap.call(capabilities)
+            logger.info("Connected; waiting for mail with %s", "IDLE" if "IDLE" in caps else "NOOP polling")
+            delay = 0
+            changed = True  # catch up on anything that arrived while we were away
+            while True:
+                if rules_changed():
+                    mtime = rules_mtime()
+                    rules = load_rules(account)
+                    matcher = RuleMatcher(rules, timed=True)
+                    logger.info("Rules file changed; reloaded rules")
+                    changed = True
+                if changed:
+                    if rules:
+                        await file_mailbox(account, aimap, smtp, caps, rules, matcher)
+                        metrics.current.write(METRICS_FILE)
+                    else:
+                        logger.warning("No rules loaded; waiting for the rules file to change")
+                if "IDLE" in caps:
+                    changed = await aimap.call(idle_wait, IDLE_TIMEOUT, interrupt=rules_changed)
+                else:
+                    changed = await aimap.call(noop_wait, POLL_INTERVAL, interrupt=rules_changed)
+        except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError) as e:
+            delay = min(MAX_RECONNECT_DELAY, max(5, delay * 2))
+            logger.warning("Connection problem (%s); reconnecting in %ss", e, delay)
+            await asyncio.sleep(delay)
+        finally:
+            if aimap is not None:
+                await aimap.logout()
+
+if __name__ == "__main__":
+    if "--watch" in sys.argv[1:]:
+        try:
+            with metrics.profile(PROFILE_FILE):
+                asyncio.run(watch())
+        except KeyboardInterrupt:
+            logger.info("Filer stopped")
+    else:
+        main()
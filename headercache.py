@@ -0,0 +1,229 @@
+# ~/bin/headercache.py
+# Decoded header features of messages already seen, shared by filer.py and
+# train_rules.py.
+#
+# Entries are keyed by (mailbox, UIDVALIDITY, UID), so a full rescan after a
+# rules change, or re-running the trainer on a folder it could not empty, is
+# a local lookup instead of a FETCH and a parse.
+# Above HEADER_CACHE_SIZE entries the least recently used ones are dropped.
+import json, logging, os, re, sqlite3, time
+from email.header import decode_header, make_header
+from email.parser import BytesHeaderParser
+from urllib.parse import urlparse
+from mailio import chunks
+
+logger = logging.getLogger(__name__)
+
+HEADER_CACHE = os.path.expanduser(os.getenv("HEADER_CACHE", "~/.imap-header-cache.db"))
+# 0 disables the cache
+HEADER_CACHE_SIZE = int(os.getenv("HEADER_CACHE_SIZE", "50000"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    mailbox     TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid         INTEGER NOT NULL,
+    features    TEXT NOT NULL,
+    used        REAL NOT NULL,
+    PRIMARY KEY (mailbox, uidvalidity, uid)
+);
+DROP INDEX IF EXISTS messages_message_id;
+CREATE INDEX IF NOT EXISTS messages_used ON messages (used);
+"""
+
+# Everything message_features() reads
+FEATURE_HEADERS = ("From", "Subject", "List-Id", "List-Unsubscribe")
+# FETCH item for just those headers, without setting \Seen
+FEATURE_FETCH = f"BODY.PEEK[HEADER.FIELDS ({' '.join(n.upper() for n in FEATURE_HEADERS)})]"
+
+# SQLite host parameters per IN (...) lookup, and rows per cache write
+LOOKUP_CHUNK = 500
+# Seconds to wait for another process's write before giving up on the cache
+LOCK_TIMEOUT = 5
+
+def h(msg, name):
+    raw = msg.get(name, "")
+    try: return str(make_header(decode_header(raw)))
+    except Exception: return raw
+
+def list_unsub_domains(msg):
+    lu = msg.get("List-Unsubscribe", "")
+    if not lu: return []
+    parts = re.findall(r"<([^>]+)>", lu) or [p.strip() for p in lu.split(",")]
+    out = []
+    for p in parts:
+        p = p.strip("<> ").lower()
+        if p.startswith("http"):
+            try:
+                host = urlparse(p).hostname
+            except ValueError:  # e.g. "http://[oops/": skip the part, not the message
+                continue
+            if host: out.append(host)
+        elif p.startswith("mailto:") and "@" in p:
+            out.append(p.split("@")[-1])
+    return out
+
+def message_features(msg):
+    """Decode the headers rules can match on, once per message (lowercased)."""
+    frm = h(msg, "From").lower()
+    subj = h(msg, "Subject").lower()
+    lid = h(msg, "List-Id").lower()
+    return {
+        "list-id": lid,
+        "list-unsubscribe": list_unsub_domains(msg),
+        "from": frm,
+        "subject": subj,
+        "any": f"{frm} {subj} {lid}",
+    }
+
+# The blank line that ends the header section
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+
+def header_block(data):
+    """The header section of a raw message, without the body."""
+    end = HEADER_END.search(data)
+    return data if end is None else data[:end.end()]
+
+def parse_features(data):
+    """message_features() of a raw message, or None if it cannot be decoded.
+
+    The body is never looked at. A message that breaks the parser is left
+    to the caller to skip, so it cannot stop a pass (or a pool batch).
+    """
+    try:
+        msg = BytesHeaderParser().parsebytes(header_block(data))
+        return message_features(msg)
+    except Exception:
+        return None
+
+def parse_many(datas):
+    # one task per batch for a process pool: pickling a list is far cheaper
+    # than a round trip to the worker per message
+    return [None if data is None else parse_features(data) for data in datas]
+
+class HeaderCache:
+    """SQLite cache of message_features() with LRU eviction on close().
+
+    The cache only saves work: if the database is locked or broken, lookups
+    miss and writes are dropped instead of failing the pass. With
+    read_only=True (replay.py) the file is never written, not even by
+    close().
+    """
+
+    def __init__(self, path=HEADER_CACHE, size=HEADER_CACHE_SIZE, read_only=False):
+        self.size = size
+        self.read_only = read_only
+        self.hits = self.misses = 0
+        self.pending = []  # rows put() since the last flush()
+        self.writable = True  # until SQLite refuses a write; then the rest are dropped
+        try:
+            if read_only:
+                self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=LOCK_TIMEOUT)
+                self.db.execute("SELECT 1 FROM messages LIMIT 1")
+            else:
+                self.db = self.open(path if size > 0 else ":memory:")
+        except sqlite3.Error as e:
+            logger.warning("Header cache %s unavailable (%s); continuing without it", path, e)
+            self.db = self.open(":memory:")
+
+    @staticmethod
+    def open(path):
+        db = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        # readers (another account, replay.py) do not wait for a writer
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        return db
+
+    def mailbox(self, mailbox, uidvalidity):
+        return MailboxCache(self, mailbox, uidvalidity)
+
+    def entries(self, mailbox=None):
+        """Yield (mailbox, uidvalidity, uid, features) in UID order, optionally for one mailbox."""
+        query = "SELECT mailbox, uidvalidity, uid, features FROM messages"
+        args = ()
+        if mailbox is not None:
+            query += " WHERE mailbox = ?"
+            args = (mailbox,)
+        for mbox, uidvalidity, uid, features in self.db.execute(query + " ORDER BY mailbox, uidvalidity, uid", args):
+            yield mbox, uidvalidity, uid, json.loads(features)
+
+    def write(self, sql, args=(), many=False):
+        """Run one write in its own short transaction; False if it was not written."""
+        if not self.writable:
+            return False
+        try:
+            with self.db:
+                (self.db.executemany if many else self.db.execute)(sql, args)
+            return True
+        except sqlite3.Error as e:
+            logger.warning("Header cache write failed (%s); not updating it this run", e)
+            self.writable = False
+            return False
+
+    def flush(self):
+        rows, self.pending = self.pending, []
+        if rows:
+            self.write("INSERT OR REPLACE INTO messages (mailbox, uidvalidity, uid, features, used) "
+                       "VALUES (?, ?, ?, ?, ?)", rows, many=True)
+
+    def close(self):
+        if self.read_only:
+            self.db.close()
+            return
+        try:
+            self.flush()
+            excess = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0] - max(self.size, 0)
+            if excess > 0 and self.write("DELETE FROM messages WHERE rowid IN "
+                                         "(SELECT rowid FROM messages ORDER BY used LIMIT ?)", (excess,)):
+                logger.debug("Evicted %d header cache entries", excess)
+        except sqlite3.Error as e:
+            logger.warning("Header cache eviction skipped (%s)", e)
+        finally:
+            self.db.close()
+
+class MailboxCache:
+    """The part of a HeaderCache for one mailbox at one UIDVALIDITY.
+
+    Without a UIDVALIDITY (the server did not report one) UIDs may be
+    reused for other messages, so nothing is looked up or stored.
+    """
+
+    def __init__(self, cache, mailbox, uidvalidity):
+        self.cache, self.mailbox, self.uidvalidity = cache, mailbox, uidvalidity
+
+    def get_many(self, uids):
+        """{uid: features} for the cached uids (keys as passed in)."""
+        if self.uidvalidity is None:
+            self.cache.misses += len(uids)
+            return {}
+        db = self.cache.db
+        by_int = {int(u): u for u in uids}
+        found = {}
+        for part in chunks(list(by_int), LOOKUP_CHUNK):
+            marks = ",".join("?" * len(part))
+            try:
+                rows = db.execute(
+                    f"SELECT uid, features FROM messages WHERE mailbox = ? AND uidvalidity = ? AND uid IN ({marks})",
+                    (self.mailbox, self.uidvalidity, *part)).fetchall()
+            except sqlite3.Error as e:
+                logger.warning("Header cache lookup failed (%s); fetching instead", e)
+                break
+            for uid, features in rows:
+                found[by_int[uid]] = json.loads(features)
+            if rows:
+                self.cache.write(
+                    f"UPDATE messages SET used = ? WHERE mailbox = ? AND uidvalidity = ? AND uid IN ({marks})",
+                    (time.time(), self.mailbox, self.uidvalidity, *part))
+        self.cache.hits += len(found)
+        self.cache.misses += len(by_int) - len(found)
+        return found
+
+    def put(self, uid, features):
+        if self.uidvalidity is None:
+            return
+        # written a chunk at a time, so no write transaction is held open
+        # while the next chunk is fetched
+        self.cache.pending.append(
+            (self.mailbox, self.uidvalidity, int(uid), json.dumps(features), time.time()))
+        if len(self.cache.pending) >= LOOKUP_CHUNK:
+            self.cache.flush()
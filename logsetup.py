@@ -0,0 +1,35 @@
+# ~/bin/logsetup.py
+# Logging for filer.py and train_rules.py.
+#
+# The scripts only configure logging when they run, not when imported (replay,
+# the benchmarks). Records go through a queue to a listener thread that writes
+# the console and the log file, so a slow disk or journal never stalls a run.
+import atexit, logging, os, queue
+from logging.handlers import QueueHandler, QueueListener
+
+FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
+
+# DEBUG adds a line per message and per rule checked (slow on big mailboxes)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+_listener = None
+
+def setup(log_file):
+    """Log to stderr and log_file at LOG_LEVEL; later calls are no-ops."""
+    global _listener
+    if _listener is not None:
+        return
+    formatter = logging.Formatter(FORMAT)
+    handlers = [logging.StreamHandler(), logging.FileHandler(os.path.expanduser(log_file))]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    q = queue.SimpleQueue()
+    _listener = QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    # QueueHandler formats the message (args, traceback) before queueing it;
+    # the listener's handlers add the timestamp and level
+    root.addHandler(QueueHandler(q))
@@ -0,0 +1,482 @@
+# ~/bin/mailio.py
+# IMAP helpers shared by filer.py and train_rules.py (keep next to the scripts)
+import imaplib, os, re, logging, select, ssl, time
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# IMAP_SSL=0 speaks plain IMAP (local test servers such as bench/fakeimap.py)
+IMAP_SSL = os.getenv("IMAP_SSL", "1") != "0"
+IMAP_PORT = int(os.getenv("IMAP_PORT", "993" if IMAP_SSL else "143"))
+
+# UIDs requested per UID FETCH; bounds memory to one chunk of responses
+FETCH_CHUNK = int(os.getenv("FETCH_CHUNK", "500"))
+
+# Upper bound on UIDs per STORE/COPY/MOVE so command lines stay well below
+# server limits even when the UID set does not compress into ranges
+MAX_UIDS_PER_COMMAND = 1000
+
+# Read-only connections used to fetch and match large backfills in parallel;
+# only used when there are more than FETCH_CHUNK messages to look at
+WORKERS = max(1, int(os.getenv("IMAP_WORKERS", "4")))
+
+# How moves keep moved mail unread; see ActionPlan
+MOVE_STRATEGY = os.getenv("MOVE_STRATEGY", "keep-unread").lower()
+
+_RESP_NUMBER = re.compile(rb"(\d+)")
+
+_FETCH_START = re.compile(rb"^\d+ \(")
+_FETCH_UID = re.compile(rb"\bUID (\d+)")
+_FETCH_FLAGS = re.compile(rb"\bFLAGS \(([^)]*)\)")
+_COPYUID = re.compile(rb"(?:COPYUID )?\d+ ([\d:,]+) ([\d:,]+)")
+
+def quote_mailbox(name):
+    return '"' + name.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+class _Metered:
+    """Counts bytes, and the calls and time of each command, into metrics."""
+
+    def send(self, data):
+        metrics.count("imap_bytes_sent", len(data))
+        super().send(data)
+
+    def read(self, size):
+        data = super().read(size)
+        metrics.count("imap_bytes_received", len(data))
+        return data
+
+    def readline(self):
+        line = super().readline()
+        metrics.count("imap_bytes_received", len(line))
+        return line
+
+    def _simple_command(self, name, *args):
+        command = f"{name} {args[0]}" if name == "UID" and args else name
+        start = time.perf_counter()
+        try:
+            return super()._simple_command(name, *args)
+        finally:
+            metrics.add_time("imap_command", time.perf_counter() - start, command=command)
+
+class MeteredIMAP4(_Metered, imaplib.IMAP4):
+    pass
+
+class MeteredIMAP4_SSL(_Metered, imaplib.IMAP4_SSL):
+    pass
+
+def connect(host, user, password, port=None):
+    start = time.perf_counter()
+    port = port or IMAP_PORT
+    imap = MeteredIMAP4_SSL(host, port) if IMAP_SSL else MeteredIMAP4(host, port)
+    try:
+        imap.login(user, password)
+    except BaseException:
+        imap.shutdown()  # e.g. too many connections: do not leave the socket open
+        raise
+    metrics.add_time("phase", time.perf_counter() - start, phase="connect")
+    return imap
+
+def capabilities(imap):
+    # imaplib only records the pre-login list; ask again once authenticated
+    try:
+        typ, dat = imap.capability()
+        if typ == "OK" and dat and dat[-1]:
+            return set(dat[-1].decode().upper().split())
+    except imaplib.IMAP4.error as e:
+        logger.debug("CAPABILITY failed: %s", e)
+    return {c.upper() for c in getattr(imap, "capabilities", ())}
+
+def _response_number(imap, code):
+    _, dat = imap.response(code)
+    if dat and dat[-1]:
+        m = _RESP_NUMBER.match(dat[-1])
+        if m:
+            return int(m.group(1))
+    return None
+
+def select_mailbox(imap, mailbox, condstore=False, readonly=False):
+    """SELECT mailbox and return its UIDVALIDITY/UIDNEXT/HIGHESTMODSEQ.
+
+    Returns None if the mailbox cannot be selected. Values the server does
+    not report are None.
+    """
+    name = quote_mailbox(mailbox) + (" (CONDSTORE)" if condstore else "")
+    typ, _ = imap.select(name, readonly=readonly)
+    if typ != "OK":
+        return None
+    return {
+        "uidvalidity": _response_number(imap, "UIDVALIDITY"),
+        "uidnext": _response_number(imap, "UIDNEXT"),
+        "highestmodseq": _response_number(imap, "HIGHESTMODSEQ"),
+    }
+
+_EXISTS = re.compile(rb"^\* \d+ (EXISTS|RECENT)\b")
+
+def _readable(imap, timeout):
+    # bytes already read into imaplib's buffer (or held by TLS) never show
+    # up in select(), so look there first without blocking
+    sock = imap.sock
+    blocking = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        if imap.file.peek(1):
+            return True
+    except (BlockingIOError, ssl.SSLWantReadError):
+        pass
+    finally:
+        sock.settimeout(blocking)
+    return bool(select.select([sock], [], [], timeout)[0])
+
+def new_mail_pending(imap):
+    """True if the server announced new mail since the last SELECT; forgets it.
+
+    Servers send "* n EXISTS" in reply to any command, such as the FETCH or
+    MOVE of a filing pass; imaplib files it under untagged_responses, where a
+    following IDLE or NOOP would never see it.
+    """
+    _, exists = imap.response("EXISTS")
+    return bool(exists and exists[0] is not None)
+
+def idle_wait(imap, timeout, interrupt=None, step=5):
+    """IDLE on the selected mailbox until new mail, timeout or interrupt().
+
+    imaplib (before Python 3.14) has no IDLE, so this speaks it directly.
+    Returns True at once if new mail was announced before the IDLE, and
+    otherwise when an untagged line announced new mail (EXISTS/RECENT) or
+    the timeout ran out; a pass after a quiet timeout is cheap and catches
+    anything the server did not announce. interrupt is polled every step
+    seconds; returns False if it ended the wait.
+    """
+    if new_mail_pending(imap):
+        return True
+    tag = imap._new_tag()
+    imap.send(tag + b" IDLE\r\n")
+    line = imap.readline()
+    if not line.startswith(b"+"):
+        raise imap.abort(f"IDLE refused: {line!r}")
+    changed = True  # unless something other than a timeout ends the wait
+    deadline = time.monotonic() + timeout
+    try:
+        while time.monotonic() < deadline:
+            if interrupt is not None and interrupt():
+                changed = False
+                break
+            if _readable(imap, min(step, max(0, deadline - time.monotonic()))):
+                line = imap.readline()
+                if not line:
+                    raise imap.abort("connection closed during IDLE")
+                changed = bool(_EXISTS.match(line))
+                break
+    finally:
+        imap.send(b"DONE\r\n")
+    # drain untagged responses up to the IDLE completion
+    while True:
+        line = imap.readline()
+        if not line:
+            raise imap.abort("connection closed after IDLE")
+        if line.startswith(tag):
+            break
+        changed = changed or bool(_EXISTS.match(line))
+    return changed
+
+def noop_wait(imap, interval, interrupt=None, step=5):
+    """Polling fallback for servers without IDLE: sleep, then NOOP.
+
+    Returns True at once if new mail was announced since the last SELECT,
+    and otherwise if the NOOP reported a changed message count.
+    """
+    if new_mail_pending(imap):
+        return True
+    deadline = time.monotonic() + interval
+    while time.monotonic() < deadline:
+        if interrupt is not None and interrupt():
+            return False
+        time.sleep(min(step, max(0, deadline - time.monotonic())))
+    imap.noop()
+    return new_mail_pending(imap)
+
+def uid_set(uids):
+    # [1,2,3,7,9,10] -> "1:3,7,9:10"; keeps commands short for long runs
+    nums = sorted({int(u) for u in uids})
+    out = []
+    i = 0
+    while i < len(nums):
+        j = i
+        while j + 1 < len(nums) and nums[j + 1] == nums[j] + 1:
+            j += 1
+        out.append(str(nums[i]) if i == j else f"{nums[i]}:{nums[j]}")
+        i = j + 1
+    return ",".join(out)
+
+def chunks(seq, size):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+def parse_fetch(data):
+    """Split an imaplib FETCH response into per-message records.
+
+    imaplib returns a flat list where each message is one or more
+    (meta, literal) tuples followed by a closing bytes item such as b')' or
+    b' UID 12)'. Messages without literals come back as plain bytes.
+    Yields dicts with "uid" (bytes), "flags" (tuple or None) and "data"
+    (the first literal, or None).
+    """
+    rec = None
+    meta = b""
+    for item in data or ():
+        if item is None:
+            continue
+        head = item[0] if isinstance(item, tuple) else item
+        if _FETCH_START.match(head):
+            if rec is not None:
+                yield _finish(rec, meta)
+            rec, meta = {"data": None}, b""
+        elif rec is None:
+            continue
+        meta += head
+        if isinstance(item, tuple) and rec["data"] is None:
+            rec["data"] = item[1]
+    if rec is not None:
+        yield _finish(rec, meta)
+
+def _finish(rec, meta):
+    m = _FETCH_UID.search(meta)
+    rec["uid"] = m.group(1) if m else None
+    f = _FETCH_FLAGS.search(meta)
+    rec["flags"] = tuple(f.group(1).decode().split()) if f else None
+    return rec
+
+def fetch_batched(imap, uids, spec, chunk=None):
+    """Stream FETCH results for uids, one UID FETCH per chunk of UIDs."""
+    chunk = chunk or FETCH_CHUNK
+    for part in chunks(list(uids), chunk):
+        typ, data = imap.uid("FETCH", uid_set(part), spec)
+        if typ != "OK":
+            logger.warning("FETCH of %d UIDs failed: %s", len(part), typ)
+            continue
+        wanted = {int(u) for u in part}
+        for rec in parse_fetch(data):
+            # skip unsolicited FETCH updates (e.g. flag changes from other clients)
+            if rec["uid"] is not None and int(rec["uid"]) in wanted:
+                yield rec
+
+def parse_action(action):
+    """Normalise the action shapes rules allow into (name, arg)."""
+    if isinstance(action, str):
+        return action, None
+    if isinstance(action, dict) and action:
+        return next(iter(action.items()))
+    if isinstance(action, (list, tuple)) and action:
+        # e.g. ['move', 'Offers'] or ['mark_read', None]
+        return action[0], action[1] if len(action) > 1 else None
+    return None, None
+
+def ensure_mailbox(imap, name):
+    try:
+        imap.create(quote_mailbox(name))
+        logger.debug("Created mailbox: %s", name)
+    except imaplib.IMAP4.error as e:
+        # Folder likely already exists; that's fine
+        logger.debug("Mailbox %s creation info: %s", name, e)
+
+def expand_uid_set(spec):
+    # "1:3,7" -> [1, 2, 3, 7]
+    out = []
+    for part in spec.split(","):
+        lo, _, hi = part.partition(":")
+        lo = int(lo)
+        hi = int(hi) if hi else lo
+        out += range(min(lo, hi), max(lo, hi) + 1)
+    return out
+
+def parse_copyuid(imap, dat):
+    """Map source UID -> destination UID from a COPYUID response (UIDPLUS).
+
+    imaplib files the response code (tagged for COPY, untagged for MOVE)
+    under "COPYUID" as b"<uidvalidity> <source set> <destination set>".
+    """
+    _, codes = imap.response("COPYUID")
+    texts = [c for c in (codes or ()) if isinstance(c, bytes)]
+    texts += [d for d in (dat or ()) if isinstance(d, bytes) and b"COPYUID" in d]
+    for text in reversed(texts):
+        m = _COPYUID.search(text)
+        if m:
+            src = expand_uid_set(m.group(1).decode())
+            dst = expand_uid_set(m.group(2).decode())
+            return {str(s): str(d) for s, d in zip(src, dst)}
+    return {}
+
+class ActionPlan:
+    """Server-side actions collected over a run, grouped by flag and destination.
+
+    Messages are only added during the scan; execute() then issues one
+    UID STORE per flag and one UID MOVE (or COPY + STORE \\Deleted) per
+    destination, each over a UID set, instead of several commands per message.
+
+    Because the actions of all messages are batched, a rule's actions are not
+    run in the order they are listed: mark_read is always applied before any
+    COPY/MOVE, so a rule with mark_read anywhere in it files the message as
+    read (the moved copy carries \\Seen), and deletes come last.
+
+    How moves treat the unread state depends on the strategy (MOVE_STRATEGY):
+
+    keep-unread  MOVE/COPY, then clear \\Seen on the destination copies of
+                 messages that were unread when fetched, using the UIDs from
+                 COPYUID. Needs UIDPLUS; without it this behaves like plain.
+    plain        MOVE/COPY only; trusts the server to preserve flags.
+    append       re-upload every message with APPEND (the old behaviour);
+                 costs a full download and upload per message.
+    """
+
+    STRATEGIES = ("keep-unread", "plain", "append")
+
+    def __init__(self, strategy=None):
+        self.strategy = strategy or MOVE_STRATEGY
+        if self.strategy not in self.STRATEGIES:
+            logger.warning("Unknown MOVE_STRATEGY %r; using keep-unread", self.strategy)
+            self.strategy = "keep-unread"
+        self.seen = []
+        self.deletes = []
+        self.unseen = set()  # messages that were unread when fetched
+        self.moves = {}     # uid -> final destination
+        self.copies = {}    # destination -> uids (earlier moves of a multi-move rule)
+
+    def add(self, uid, name, arg=None, flags=None):
+        uid = uid.decode() if isinstance(uid, bytes) else str(uid)
+        if flags is not None and "\\Seen" not in flags:
+            self.unseen.add(uid)
+        if name == "mark_read":
+            self.seen.append(uid)
+        elif name == "delete":
+            self.deletes.append(uid)
+        elif name == "move":
+            if uid in self.moves:
+                self.copies.setdefault(self.moves[uid], []).append(uid)
+            self.moves[uid] = arg
+        else:
+            return False
+        return True
+
+    def __len__(self):
+        return len(set(self.seen) | set(self.deletes) | set(self.moves))
+
+    def destinations(self):
+        groups = {}
+        for uid, dest in self.moves.items():
+            groups.setdefault(dest, []).append(uid)
+        return groups
+
+    def _store(self, imap, uids, op, flags):
+        done = []
+        for part in chunks(uids, MAX_UIDS_PER_COMMAND):
+            typ, dat = imap.uid("STORE", uid_set(part), op, flags)
+            if typ == "OK":
+                done += part
+            else:
+                logger.error("STORE %s %s on %d messages failed: %s", op, flags, len(part), dat)
+        return done
+
+    def _transfer(self, imap, cmd, uids, dest):
+        """COPY/MOVE uids to dest; returns {source uid: destination uid or None}."""
+        done = {}
+        for part in chunks(uids, MAX_UIDS_PER_COMMAND):
+            imap.response("COPYUID")  # drop stale codes
+            typ, dat = imap.uid(cmd, uid_set(part), quote_mailbox(dest))
+            if typ == "OK":
+                mapping = parse_copyuid(imap, dat)
+                done.update({u: mapping.get(u) for u in part})
+            else:
+                logger.error("%s of %d messages to %s failed: %s", cmd, len(part), dest, dat)
+        return done
+
+    def _append(self, imap, uids, dest):
+        # the old way: download each message and upload it again with APPEND
+        done = {}
+        seen = set(self.seen)
+        for rec in fetch_batched(imap, uids, "(FLAGS BODY.PEEK[])"):
+            if rec["data"] is None:
+                continue
+            uid = rec["uid"].decode()
+            was_read = rec["flags"] is not None and "\\Seen" in rec["flags"]
+            flags = r"(\Seen)" if uid in seen or was_read else None
+            try:
+                typ, dat = imap.append(quote_mailbox(dest), flags, None, rec["data"])
+            except imaplib.IMAP4.error as e:
+                typ, dat = "NO", [str(e)]
+            if typ == "OK":
+                done[uid] = None
+            else:
+                logger.error("[UID %s] APPEND to %s failed: %s", uid, dest, dat)
+        return done
+
+    def _restore_unseen(self, imap, mailbox, restore):
+        # clearing \Seen on the copies needs the destination selected; keep
+        # any new mail announced for mailbox across the SELECTs, which drop it
+        pending = imap.untagged_responses.pop("EXISTS", None) if restore else None
+        for dest, uids in restore.items():
+            typ, _ = imap.select(quote_mailbox(dest))
+            if typ != "OK":
+                logger.error("Could not select %s to keep moved messages unread", dest)
+                continue
+            self._store(imap, uids, "-FLAGS.SILENT", r"(\Seen)")
+            logger.debug("Kept %d moved messages unread in %s", len(uids), dest)
+        if restore:
+            imap.select(quote_mailbox(mailbox))
+        if pending:
+            imap.untagged_responses["EXISTS"] = pending
+
+    def execute(self, imap, caps=(), mailbox="INBOX"):
+        """Run the plan on the selected mailbox; returns the UIDs whose actions failed.
+
+        mailbox must be the selected mailbox; it is re-selected if the
+        keep-unread strategy had to visit destination folders. A failed
+        command is logged and the rest of the plan still runs; the UIDs it
+        covered are returned (as str) so the caller can try them again.
+        """
+        failed = set()
+        use_move = "MOVE" in caps and self.strategy != "append"
+        destinations = self.destinations()
+        for dest in sorted(set(destinations) | set(self.copies)):
+            ensure_mailbox(imap, dest)  # once per run, not once per message
+
+        if self.strategy == "keep-unread" and "UIDPLUS" not in caps and destinations:
+            logger.debug("Server lacks UIDPLUS; moved messages keep whatever flags the server gives them")
+
+        # flags first, so COPY/MOVE carry \Seen to the destination
+        if self.seen:
+            done = self._store(imap, self.seen, "+FLAGS.SILENT", r"(\Seen)")
+            failed.update(set(self.seen) - set(done))
+            logger.info("Marked %d messages as read", len(done))
+
+        for dest, uids in self.copies.items():
+            failed.update(set(uids) - set(self._transfer(imap, "COPY", uids, dest)))
+
+        to_delete = list(self.deletes)
+        restore = {}
+        seen = set(self.seen)
+        for dest, uids in destinations.items():
+            if self.strategy == "append":
+                moved = self._append(imap, uids, dest)
+            elif use_move:
+                moved = self._transfer(imap, "MOVE", uids, dest)
+            else:
+                moved = self._transfer(imap, "COPY", uids, dest)
+            failed.update(set(uids) - set(moved))
+            if not use_move:
+                # only flag originals whose copy succeeded
+                to_delete += list(moved)
+            if self.strategy == "keep-unread":
+                keep = [d for s, d in moved.items() if d and s in self.unseen and s not in seen]
+                if keep:
+                    restore[dest] = keep
+            logger.info("Moved %d messages to %s", len(moved), dest)
+
+        if to_delete:
+            failed.update(set(to_delete) - set(self._store(imap, to_delete, "+FLAGS.SILENT", r"(\Deleted)")))
+            if self.deletes:
+                logger.info("Marked %d messages for deletion", len(self.deletes))
+
+        self._restore_unseen(imap, mailbox, restore)
+        if failed:
+            logger.warning("Actions failed for %d messages; they are retried on the next run", len(failed))
+        return failed
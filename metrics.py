@@ -0,0 +1,145 @@
+# ~/bin/metrics.py
+# Per-run timings and counters for filer.py and train_rules.py.
+#
+# The scripts call start("filer") once per process. After that, phases are
+# timed with span(), and mailio's connection class counts every IMAP command,
+# with its time and bytes, into the same registry. write() exports the totals
+# after each run as a JSON summary, or as a Prometheus textfile when the path
+# ends in .prom (for node_exporter's textfile collector). Watch mode keeps
+# one registry, so the counters are cumulative, as Prometheus expects.
+import contextlib, cProfile, json, logging, os, tempfile, threading, time
+
+logger = logging.getLogger(__name__)
+
+class Metrics:
+    """Counters and timers keyed by name and labels."""
+
+    def __init__(self, job):
+        self.job = job
+        self.started = time.time()
+        self.runs = 0
+        self.last_run = {}
+        self.counters = {}  # (name, labels) -> value
+        self.timers = {}    # (name, labels) -> [calls, seconds]
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def add_time(self, name, seconds, calls=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            t = self.timers.setdefault(key, [0, 0.0])
+            t[0] += calls
+            t[1] += seconds
+
+    @contextlib.contextmanager
+    def span(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time("phase", time.perf_counter() - start, phase=phase)
+
+    def finish_run(self, started, **info):
+        """Record the end of one run (one filing pass, one training run)."""
+        self.runs += 1
+        self.last_run = {"started": started, "seconds": round(time.time() - started, 3), **info}
+
+    def summary(self):
+        out = {"job": self.job, "started": self.started, "runs": self.runs, "last_run": self.last_run}
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                _put(out.setdefault("counters", {}), name, labels, value)
+            for (name, labels), (calls, seconds) in sorted(self.timers.items()):
+                _put(out.setdefault("timers", {}), name, labels, {"calls": calls, "seconds": round(seconds, 6)})
+        return out
+
+    def prometheus(self):
+        prefix = f"imap_{self.job}"
+        lines = []
+        def emit(name, kind, samples):
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.extend(f"{prefix}_{name}{_labels(labels)} {value}" for labels, value in samples)
+        with self._lock:
+            by_name = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                by_name.setdefault(name, []).append((labels, value))
+            for name, samples in by_name.items():
+                emit(f"{name}_total", "counter", samples)
+            by_name = {}
+            for (name, labels), value in sorted(self.timers.items()):
+                by_name.setdefault(name, []).append((labels, value))
+            for name, samples in by_name.items():
+                emit(f"{name}_calls_total", "counter", [(l, v[0]) for l, v in samples])
+                emit(f"{name}_seconds_total", "counter", [(l, round(v[1], 6)) for l, v in samples])
+        emit("runs_total", "counter", [((), self.runs)])
+        if self.last_run:
+            emit("last_run_timestamp_seconds", "gauge", [((), round(self.last_run["started"], 3))])
+            emit("last_run_duration_seconds", "gauge", [((), self.last_run["seconds"])])
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        if not path:
+            return
+        try:
+            body = self.prometheus() if path.endswith(".prom") else json.dumps(self.summary(), indent=1) + "\n"
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".imap-metrics.")
+            with os.fdopen(fd, "w") as f:
+                f.write(body)
+            os.replace(tmp, path)
+        except Exception as e:
+            logger.warning("Could not write metrics to %s: %s", path, e)
+
+def _put(group, name, labels, value):
+    if not labels and name not in group:
+        group[name] = value
+        return
+    if name in group and not isinstance(group[name], list):
+        # the same name with and without labels (filer and trainer in one run)
+        group[name] = [{"value": group[name]}]
+    group.setdefault(name, []).append({**dict(labels), "value": value})
+
+def _labels(labels):
+    if not labels:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+# The registry the scripts and mailio report into; replaced by start()
+current = Metrics("imap")
+
+def start(job):
+    global current
+    current = Metrics(job)
+    return current
+
+def count(name, n=1, **labels):
+    current.count(name, n, **labels)
+
+def add_time(name, seconds, calls=1, **labels):
+    current.add_time(name, seconds, calls, **labels)
+
+def span(phase):
+    return current.span(phase)
+
+@contextlib.contextmanager
+def profile(path):
+    """cProfile the block and dump pstats to path (no-op when path is empty).
+
+    Only the calling thread is profiled; IMAP commands run in worker threads
+    and show up as time spent awaiting them.
+    """
+    if not path:
+        yield
+        return
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(path)
+        logger.info("Wrote profile to %s (python3 -m pstats %s)", path, path)
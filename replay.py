@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# ~/bin/replay.py
+# Dry run: evaluate a ruleset against a local corpus without touching IMAP.
+#
+#   python3 ~/bin/replay.py --maildir ~/Mail/INBOX
+#   python3 ~/bin/replay.py --mbox export.mbox --show all
+#   python3 ~/bin/replay.py --cache INBOX --rules candidate.yaml
+#
+# By default the candidate is ~/.imap-rules.yaml as it is on disk now and the
+# baseline is the ruleset the filer last imported (~/.imap-rules.db), so after
+# editing the YAML this shows what the next filer run would do differently.
+import argparse, json, logging, mailbox, os, sys, time
+from email.parser import BytesHeaderParser
+import yaml
+from headercache import HeaderCache, message_features
+from matcher import RuleMatcher
+from rulestore import RULES_DB, RULES_FILE, YAML_LOADER, RuleStore
+
+def load_yaml_rules(path):
+    with open(os.path.expanduser(path)) as f:
+        return (yaml.load(f, Loader=YAML_LOADER) or {}).get("rules") or []
+
+def load_stored_rules():
+    # no rule store yet (fresh install): compare against no rules at all
+    if not os.path.exists(RULES_DB):
+        return []
+    store = RuleStore(read_only=True)
+    try:
+        return store.rules()
+    finally:
+        store.close()
+
+def read_folder(box, name):
+    """(label, features) for each message of a mailbox.Mailbox."""
+    parser = BytesHeaderParser()
+    for key in box.iterkeys():
+        yield f"{name}:{key}", message_features(parser.parsebytes(box.get_bytes(key)))
+
+def read_cache(folder=None):
+    cache = HeaderCache(read_only=True)
+    try:
+        for mbox, _, uid, features in cache.entries(folder):
+            yield f"{mbox}:{uid}", features
+    finally:
+        cache.close()
+
+def describe(idx, rule):
+    if rule is None:
+        return "no match"
+    m = rule.get("match") or {}
+    actions = ", ".join(a if isinstance(a, str) else " ".join(f"{k} {v}" for k, v in a.items())
+                        for a in rule.get("actions") or [])
+    return f"rule {idx + 1} ({m.get('header')}~{m.get('contains')}: {actions})"
+
+def outcome(rule):
+    # two rules with the same actions file a message identically
+    return None if rule is None else json.dumps(rule.get("actions"), sort_keys=True)
+
+def run_matcher(rules, corpus, repeat):
+    """Match every message; returns (results, build seconds, match seconds)."""
+    start = time.perf_counter()
+    matcher = RuleMatcher(rules)
+    built = time.perf_counter()
+    for _ in range(repeat):
+        results = [matcher.match(features) for _, features in corpus]
+    return results, built - start, (time.perf_counter() - built) / repeat
+
+def rate(count, seconds):
+    return f"{count / seconds:,.0f} msg/s" if seconds > 0 else "n/a"
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay rules against local mail without changing anything")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("--maildir", help="Maildir folder to read")
+    src.add_argument("--mbox", help="mbox file to read")
+    src.add_argument("--cache", nargs="?", const="", metavar="MAILBOX",
+                     help="read the filer's header cache (all mailboxes, or just MAILBOX)")
+    ap.add_argument("--rules", default=RULES_FILE, help="candidate rules YAML (default: %(default)s)")
+    ap.add_argument("--baseline", help="baseline rules YAML (default: the rules the filer last imported)")
+    ap.add_argument("--show", choices=("changed", "all", "none"), default="changed",
+                    help="which messages to list (default: %(default)s)")
+    ap.add_argument("--repeat", type=int, default=1, help="match the corpus this many times for timing")
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s - %(message)s")
+
+    candidate = load_yaml_rules(args.rules)
+    baseline = load_yaml_rules(args.baseline) if args.baseline else load_stored_rules()
+
+    start = time.perf_counter()
+    if args.maildir:
+        name = os.path.expanduser(args.maildir)
+        corpus = list(read_folder(mailbox.Maildir(name, factory=None, create=False), os.path.basename(name)))
+    elif args.mbox:
+        name = os.path.expanduser(args.mbox)
+        corpus = list(read_folder(mailbox.mbox(name, factory=None, create=False), os.path.basename(name)))
+    else:
+        name = f"header cache ({args.cache or 'all mailboxes'})"
+        corpus = list(read_cache(args.cache or None))
+    loaded = time.perf_counter() - start
+    if not corpus:
+        print(f"No messages in {name}")
+        return 1
+
+    after, build_after, match_after = run_matcher(candidate, corpus, max(args.repeat, 1))
+    before, build_before, match_before = run_matcher(baseline, corpus, max(args.repeat, 1))
+
+    hits = [0] * len(candidate)
+    changed = []
+    for (label, features), (idx, rule), (old_idx, old_rule) in zip(corpus, after, before):
+        if rule is not None:
+            hits[idx] += 1
+        moved = outcome(rule) != outcome(old_rule)
+        if moved:
+            changed.append(label)
+        if args.show == "all" or (args.show == "changed" and moved):
+            line = f"{label}: {describe(idx, rule)}"
+            if moved:
+                line += f"  [was {describe(old_idx, old_rule)}]"
+            print(f"{line}\n    From: {features['from'][:70]}  Subject: {features['subject'][:70]}")
+
+    n = len(corpus)
+    matched = sum(hits)
+    was_matched = sum(1 for _, r in before if r is not None)
+    print(f"\nCorpus: {n} messages from {name}, read in {loaded:.2f}s ({rate(n, loaded)})")
+    print(f"Candidate: {len(candidate)} rules from {args.rules}; "
+          f"baseline: {len(baseline)} rules from {args.baseline or RULES_DB}")
+    print(f"Matched: {matched} (baseline {was_matched}); unmatched: {n - matched}")
+    print(f"Changed outcome vs baseline: {len(changed)}")
+    print("Hits per rule:")
+    for idx, rule in enumerate(candidate):
+        flag = "" if hits[idx] else "  (no hits)"
+        print(f"  {hits[idx]:>7}  {describe(idx, rule)}{flag}")
+    print(f"Matcher: candidate built in {build_after * 1000:.1f}ms, {rate(n, match_after)}; "
+          f"baseline built in {build_before * 1000:.1f}ms, {rate(n, match_before)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
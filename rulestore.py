@@ -0,0 +1,195 @@
+# ~/bin/rulestore.py
+# SQLite rule store shared by filer.py and train_rules.py.
+#
+# Rules are kept in ~/.imap-rules.db, one row per rule, ordered by position
+# (first match wins) and indexed by (header, contains), so the trainer's
+# upserts are an index lookup instead of a scan over every rule. The YAML
+# file stays the place to read and hand-edit rules: it is re-imported when
+# it changes on disk and re-exported whenever the trainer changes the rules.
+# The filer adds its hits per rule after every pass (rule_stats), which
+# compact_rules.py uses to find rules that no longer match anything.
+import json, logging, os, sqlite3, tempfile, time
+import yaml
+
+logger = logging.getLogger(__name__)
+
+RULES_FILE = os.path.expanduser("~/.imap-rules.yaml")
+RULES_DB = os.path.expanduser(os.getenv("RULES_DB", "~/.imap-rules.db"))
+
+# libyaml's parser and emitter are much faster than the pure-Python ones
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rules (
+    position INTEGER PRIMARY KEY,
+    header   TEXT,
+    contains TEXT,
+    rule     TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rules_match ON rules (header, contains);
+CREATE TABLE IF NOT EXISTS rule_stats (
+    header    TEXT,
+    contains  TEXT,
+    hits      INTEGER NOT NULL DEFAULT 0,
+    idle_runs INTEGER NOT NULL DEFAULT 0,
+    last_hit  REAL,
+    PRIMARY KEY (header, contains)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+def match_key(rule):
+    """The indexed (header, contains) of a rule, or (None, None)."""
+    m = rule.get("match") if isinstance(rule, dict) else None
+    if isinstance(m, dict) and isinstance(m.get("header"), str) and isinstance(m.get("contains"), str):
+        return m["header"], m["contains"]
+    return None, None
+
+class RuleStore:
+    """Ordered rules in SQLite with YAML import/export for hand editing."""
+
+    def __init__(self, path=RULES_DB, yaml_path=RULES_FILE, timeout=30, read_only=False):
+        self.path, self.yaml_path = path, yaml_path
+        if read_only:
+            # replay.py: never create or change the file
+            self.db = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=timeout)
+        else:
+            self.db = sqlite3.connect(path, timeout=timeout)
+            self.db.executescript(SCHEMA)
+        self.dirty = False
+        # upserts not yet written: (header, contains) -> actions, in order
+        self.pending = {}
+
+    def close(self):
+        self.db.close()
+
+    def _meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def _yaml_mtime(self):
+        try:
+            return str(os.stat(self.yaml_path).st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def sync(self):
+        """Import the YAML file if it changed since the last import/export.
+
+        Returns True if the rules were replaced. A YAML file that fails to
+        parse is logged and the stored rules are kept.
+        """
+        mtime = self._yaml_mtime()
+        if mtime is None or mtime == self._meta("yaml_mtime"):
+            return False
+        try:
+            with open(self.yaml_path) as f:
+                doc = yaml.load(f, Loader=YAML_LOADER) or {}
+            rules = doc.get("rules") or []
+        except Exception as e:
+            logger.error("Error loading rules from %s, keeping stored rules: %s", self.yaml_path, e)
+            return False
+        with self.db:
+            self.db.execute("DELETE FROM rules")
+            self.db.executemany(
+                "INSERT INTO rules (position, header, contains, rule) VALUES (?, ?, ?, ?)",
+                ((i, *match_key(r), json.dumps(r)) for i, r in enumerate(rules)))
+            # keep any other top-level keys so the export round-trips
+            self._set_meta("document", json.dumps({k: v for k, v in doc.items() if k != "rules"}))
+            self._set_meta("yaml_mtime", mtime)
+        logger.info("Imported %d rules from %s", len(rules), self.yaml_path)
+        return True
+
+    def rules(self):
+        return [json.loads(r) for (r,) in self.db.execute("SELECT rule FROM rules ORDER BY position")]
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM rules").fetchone()[0]
+
+    def _first(self, header, contains):
+        return self.db.execute(
+            "SELECT position, rule FROM rules WHERE header = ? AND contains = ? ORDER BY position LIMIT 1",
+            (header, contains)).fetchone()
+
+    def upsert(self, header, contains, actions):
+        """Set the actions of the first header/contains rule, or append one.
+
+        Returns "added" or "updated". Changes are held in memory and written
+        by save() in one short transaction, so a trainer run fetching mail
+        does not keep the database locked against the filer.
+        """
+        known = (header, contains) in self.pending or self._first(header, contains) is not None
+        self.pending[(header, contains)] = actions
+        self.dirty = True
+        return "updated" if known else "added"
+
+    def _write_pending(self):
+        for (header, contains), actions in self.pending.items():
+            row = self._first(header, contains)
+            if row:
+                rule = json.loads(row[1])
+                rule["actions"] = actions
+                self.db.execute("UPDATE rules SET rule = ? WHERE position = ?", (json.dumps(rule), row[0]))
+            else:
+                rule = {"match": {"header": header, "contains": contains}, "actions": actions}
+                self.db.execute("INSERT INTO rules (header, contains, rule) VALUES (?, ?, ?)",
+                                (header, contains, json.dumps(rule)))
+        self.pending = {}
+
+    def remove(self, indexes):
+        """Delete the rules at these indexes of rules(). Committed by save()."""
+        positions = [p for (p,) in self.db.execute("SELECT position FROM rules ORDER BY position")]
+        self.db.executemany("DELETE FROM rules WHERE position = ?", ((positions[i],) for i in indexes))
+        self.dirty = True
+
+    def record_hits(self, hits):
+        """Add one filing pass: hits maps (header, contains) -> messages matched.
+
+        Every other rule goes one more pass without a hit. Stats are kept per
+        match key, so they survive reordering the rules in the YAML file.
+        """
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO rule_stats (header, contains) "
+                "SELECT DISTINCT header, contains FROM rules WHERE header IS NOT NULL")
+            self.db.execute(
+                "DELETE FROM rule_stats WHERE NOT EXISTS "
+                "(SELECT 1 FROM rules r WHERE r.header = rule_stats.header AND r.contains = rule_stats.contains)")
+            self.db.execute("UPDATE rule_stats SET idle_runs = idle_runs + 1")
+            now = time.time()
+            self.db.executemany(
+                "UPDATE rule_stats SET hits = hits + ?, idle_runs = 0, last_hit = ? WHERE header = ? AND contains = ?",
+                ((n, now, header, contains) for (header, contains), n in hits.items() if header is not None))
+
+    def hit_stats(self):
+        """{(header, contains): (hits, passes since the last hit, last hit time or None)}"""
+        return {(header, contains): (hits, idle, last)
+                for header, contains, hits, idle, last
+                in self.db.execute("SELECT header, contains, hits, idle_runs, last_hit FROM rule_stats")}
+
+    def save(self):
+        """Write pending upserts and removals and export the rules to the YAML file."""
+        if not self.dirty:
+            return
+        with self.db:
+            self._write_pending()
+        self.export()
+        self.dirty = False
+
+    def export(self):
+        doc = json.loads(self._meta("document") or "{}")
+        doc["rules"] = self.rules()
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.yaml_path) or ".", prefix=".imap-rules.")
+        with os.fdopen(fd, "w") as f:
+            yaml.dump(doc, f, Dumper=YAML_DUMPER, sort_keys=False)
+        os.replace(tmp, self.yaml_path)
+        with self.db:
+            self._set_meta("yaml_mtime", self._yaml_mtime())
+        logger.info("Saved %d rules to %s", len(doc["rules"]), self.yaml_path)
@@ -1,23 +1,30 @@
 #!/usr/bin/env python3
-import imaplib, email, os, re, ssl, yaml, tempfile, shutil, logging
-from email.header import decode_header, make_header
-from urllib.parse import urlparse
-
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler(os.path.expanduser("~/.imap-trainer.log"))
-    ]
-)
+import asyncio, collections, email, os, re, logging, time
+import logsetup, metrics
+from mailio import ActionPlan, FETCH_CHUNK, WORKERS, capabilities, select_mailbox
+from asyncmail import Account
+from rulestore import RULES_DB, RULES_FILE, RuleStore
+from headercache import FEATURE_FETCH, HEADER_CACHE, HeaderCache, message_features
+
 logger = logging.getLogger(__name__)
 
+LOG_FILE = "~/.imap-trainer.log"
+
 IMAP_HOST = os.getenv("IMAP_HOST", "imap.mailbox.org")
 IMAP_USER = os.getenv("IMAP_USER")
 IMAP_PASS = os.getenv("IMAP_PASS")
 
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.mailbox.org")
+SMTP_USER = os.getenv("SMTP_USER", IMAP_USER)
+SMTP_PASS = os.getenv("SMTP_PASS", IMAP_PASS)
+
+# Forwards wait here until the SMTP server accepts them
+SPOOL_DIR = os.path.expanduser(os.getenv("TRAINER_SPOOL", "~/.imap-trainer-spool"))
+
+# Run metrics and optional cProfile dump, as FILER_METRICS/FILER_PROFILE
+METRICS_FILE = os.path.expanduser(os.getenv("TRAINER_METRICS", "~/.imap-trainer-metrics.json"))
+PROFILE_FILE = os.path.expanduser(os.getenv("TRAINER_PROFILE", ""))
+
 TRAIN_MAP = {
     "Train/Newsletters": [("move", "Newsletters")],
     "Train/Updates": [("move", "Updates")],
@@ -28,80 +35,39 @@ TRAIN_MAP = {
     "Train/AutoDelete": [("move", "Autodelete")],
 }
 
-RULES_FILE = os.path.expanduser("~/.imap-rules.yaml")
-
-def h(msg, name):
-    raw = msg.get(name, "")
-    try:
-        return str(make_header(decode_header(raw)))
-    except Exception:
-        return raw
 
-def extract_listid(msg):
-    lid = h(msg, "List-Id")
+# Keys are chosen from message_features(), so messages already in the header
+# cache (same folder, UIDVALIDITY and UID) need no FETCH at all.
+def extract_listid(features):
+    lid = features["list-id"]
     if not lid: return None
     m = re.search(r"<([^>]+)>", lid)
-    return m.group(1).strip().lower() if m else lid.strip().lower()
-
-def extract_listunsub(msg):
-    lu = msg.get("List-Unsubscribe", "")
-    if not lu: return None
-    # find all things inside <> first; else split on commas
-    parts = re.findall(r"<([^>]+)>", lu) or [p.strip() for p in lu.split(",")]
-    for p in parts:
-        p = p.strip("<> ").lower()
-        if p.startswith("http"):
-            host = urlparse(p).hostname
-            if host: return host
-        if p.startswith("mailto:") and "@" in p:
-            return p.split("@")[-1]
-    return None
+    return m.group(1).strip() if m else lid.strip()
+
+def extract_listunsub(features):
+    domains = features["list-unsubscribe"]
+    return domains[0] if domains else None
 
-def from_domain(msg):
-    frm = h(msg, "From").lower()
+def from_domain(features):
+    frm = features["from"]
     m = re.search(r'@([a-z0-9\.\-]+\.[a-z]{2,})', frm)
     domain = m.group(1) if m else frm
     
     # Skip provider/masking domains and personal domains that are too broad
     blocked_domains = {'duck.com', 'protonmail.com', 'gmail.com', 'yahoo.com', 'outlook.com', 'linehan.me.uk'}
     if domain.lower() in blocked_domains:
-        logger.debug(f"Skipping blocked provider domain: {domain}")
+        logger.debug("Skipping blocked provider domain: %s", domain)
         return None
     
     return domain
 
-def subject_hint(msg):
-    s = h(msg, "Subject").lower()
+def subject_hint(features):
+    s = features["subject"]
     for kw in ("itinerary","booking","reservation","boarding","ticket","trip","flight"):
         if kw in s:
             return kw
     return None
 
-def load_rules():
-    try:
-        if os.path.exists(RULES_FILE):
-            with open(RULES_FILE) as f:
-                rules = yaml.safe_load(f) or {"rules":[]}
-            logger.info(f"Loaded {len(rules.get('rules', []))} existing rules from {RULES_FILE}")
-            return rules
-        else:
-            logger.info(f"Rules file not found; starting with empty rules")
-            return {"rules":[]}
-    except Exception as e:
-        logger.error(f"Error loading rules: {e}")
-        return {"rules":[]}
-
-def save_rules(data):
-    try:
-        d = tempfile.mkdtemp()
-        tmp = os.path.join(d, "imap-rules.yaml.tmp")
-        with open(tmp, "w") as f:
-            yaml.safe_dump(data, f, sort_keys=False)
-        shutil.move(tmp, RULES_FILE)
-        logger.info(f"Saved {len(data.get('rules', []))} rules to {RULES_FILE}")
-    except Exception as e:
-        logger.error(f"Error saving rules: {e}")
-
 def _norm_actions(actions):
     out = []
     for a in actions:
@@ -122,152 +88,210 @@ def _norm_actions(actions):
                 out.append({name: arg})
     return out
 
-def upsert_rule(data, header, contains, actions):
+def upsert_rule(store, header, contains, actions):
     actions = _norm_actions(actions)
-    for r in data["rules"]:
-        if r.get("match", {}).get("header") == header and r["match"].get("contains") == contains:
-            logger.debug(f"Updated existing rule: {header}={contains} -> {actions}")
-            r["actions"] = actions
-            return
-    logger.debug(f"Added new rule: {header}={contains} -> {actions}")
-    data["rules"].append({
-        "match": {"header": header, "contains": contains},
-        "actions": actions
-    })
-
-def ensure_mailbox(imap, name):
-    try:
-        imap.create(name)
-        logger.debug(f"Created mailbox: {name}")
-    except imaplib.IMAP4.error as e:
-        logger.debug(f"Mailbox {name} creation info: {e}")
+    result = store.upsert(header, contains, actions)
+    metrics.count("rules", result=result)
+    logger.debug("%s rule: %s=%s -> %s", "Added new" if result == "added" else "Updated existing", header, contains, actions)
+    return result
 
-def do_actions(imap, uid, actions):
-    for a in actions:
-        try:
-            if a[0]=="mark_read":
-                imap.uid("STORE", uid, "+FLAGS", r"(\Seen)")
-                logger.info(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Marked as read")
-            elif a[0]=="move":
-                dest = a[1]
-                ensure_mailbox(imap, dest)
-                imap.uid("COPY", uid, dest)
-                imap.uid("STORE", uid, "+FLAGS", r"(\Deleted)")
-                logger.info(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Moved to {dest}")
-            elif a[0]=="forward":
-                # No-op here; the filer handles forwarding for INBOX matches.
-                # We'll forward now too (nice immediate feedback):
-                raw = imap.uid("FETCH", uid, "(RFC822)")[1][0][1]
-                send_forward(raw, a[1])
-        except Exception as e:
-            logger.error(f"  [UID {uid.decode() if isinstance(uid, bytes) else uid}] Error performing action '{a[0]}': {e}")
-
-def send_forward(raw_bytes, to_addr):
-    # Minimal SMTP forward as message/rfc822 attachment (works with TripIt)
-    import smtplib
-    from email.message import EmailMessage
+def choose_keys(uid, features, train):
+    """The rule keys for one training message: [(header, contains), ...] or None."""
+    logger.debug("Processing UID %s from %s: From=%.50s, Subject=%.50s",
+                 int(uid), train, features["from"], features["subject"])
+
+    # choose best key
+    header, key = None, None
+    lid = extract_listid(features)
+    if lid:
+        header, key = "List-Id", lid
+        logger.debug("  Extracted List-Id: %s", lid)
+    else:
+        lu = extract_listunsub(features)
+        if lu:
+            header, key = "List-Unsubscribe", lu
+            logger.debug("  Extracted List-Unsubscribe: %s", lu)
+        else:
+            dom = from_domain(features)
+            if dom:  # Skip if from_domain returns None (blocked provider)
+                header, key = "From", dom
+                logger.debug("  Extracted From domain: %s", dom)
+            else:
+                logger.debug("  Skipping UID %s: no extractable domain (blocked provider)", int(uid))
+                return None
+
+    keys = [(header, key)]
+    if train == "Train/Travel":
+        sh = subject_hint(features)
+        logger.debug("  Travel message - storing domain rule %s=%s", header, key)
+        # Store the domain rule regardless; add a subject rule if we found a hint
+        if sh:
+            logger.debug("  Found travel subject hint: %s", sh)
+            keys.append(("Subject", sh))
+    return keys
+
+def learn(rec, train, cache=None):
+    """Choose the rule keys for one fetched training message.
+
+    rec carries only the header fields message_features() reads. Returns
+    (uid, [(header, contains), ...], flags) or None if the message gives no
+    usable key. The decoded features are stored in cache (a MailboxCache)
+    when one is given.
+    """
+    uid, data = rec["uid"], rec["data"]
     try:
-        smtp_host = os.getenv("SMTP_HOST", "smtp.mailbox.org")
-        smtp_user = os.getenv("SMTP_USER", IMAP_USER)
-        smtp_pass = os.getenv("SMTP_PASS", IMAP_PASS)
-        msg = EmailMessage()
-        msg["From"] = smtp_user
-        msg["To"] = to_addr
-        msg["Subject"] = "Fwd: travel docs"
-        msg.set_content("Forwarded itinerary/booking.")
-        msg.add_attachment(raw_bytes, maintype="message", subtype="rfc822", filename="message.eml")
-        with smtplib.SMTP_SSL(smtp_host, 465) as s:
-            s.login(smtp_user, smtp_pass)
-            s.send_message(msg)
-        logger.info(f"Forwarded message to {to_addr}")
+        if data is None:
+            raise ValueError("empty FETCH response")
+        msg = email.message_from_bytes(data)
+        features = message_features(msg)
+        if cache is not None:
+            cache.put(uid, features)
+        keys = choose_keys(uid, features, train)
+        if not keys:
+            return None
+        return uid, keys, rec["flags"]
+
     except Exception as e:
-        logger.error(f"Failed to forward to {to_addr}: {e}")
+        logger.error("Error processing UID %s: %s", int(uid), e)
+        return None
+
+async def train_folder(account, aimap, smtp, caps, train, actions, store):
+    """Learn from and empty one Train/* folder; returns messages trained.
+
+    One streaming pass over the header fields (or the header cache) picks
+    the keys and plans the actions; the plan then runs as bulk UID
+    STORE/MOVE commands. Only messages to forward are downloaded in full.
+    """
+    with metrics.span("select"):
+        info = await aimap.call(select_mailbox, train)
+    if info is None:
+        logger.debug("Could not select %s (folder may not exist)", account.label(train))
+        return 0
+
+    with metrics.span("search"):
+        typ, data = await aimap.uid("SEARCH", None, "ALL")
+    uids = data[0].split() if data and data[0] else []
+    logger.debug("Found %d messages in %s", len(uids), train)
+
+    plan = ActionPlan()
+    forwards = [arg for name, arg in actions if name == "forward"]
+    to_forward = []
+    trained = 0
+    results = collections.Counter()  # "added" / "updated" rules
+    def apply(uid, keys, flags):
+        nonlocal trained
+        for header, key in keys:
+            results[upsert_rule(store, header, key, actions)] += 1
+        logger.debug("Training on %s: %s=%s", train, keys[0][0], keys[0][1])
+        for name, arg in actions:
+            if name != "forward":
+                plan.add(uid, name, arg, flags=flags)
+        if forwards:
+            to_forward.append(uid)
+        trained += 1
+
+    cache = HeaderCache(account.header_cache)
+    try:
+        seen = cache.mailbox(train, info["uidvalidity"])
+        with metrics.span("cache_lookup"):
+            cached = seen.get_many(uids)
+        if cached:
+            logger.debug("Training on %d messages from the header cache", len(cached))
+            keys = {uid: k for uid, features in cached.items() if (k := choose_keys(uid, features, train))}
+            async for rec in aimap.fetch(sorted(keys, key=int), "(FLAGS)"):
+                apply(rec["uid"], keys[rec["uid"]], rec["flags"])
+        fetch = [u for u in uids if u not in cached]
+
+        with metrics.span("fetch_learn"):
+            spec = f"(FLAGS {FEATURE_FETCH})"
+            learned = None
+            if WORKERS > 1 and len(fetch) > FETCH_CHUNK:
+                # large folder: parse over several connections, act on this one
+                learned = await account.fetch_sharded(train, fetch, spec, lambda rec: learn(rec, train, cache=seen))
+            if learned is not None:
+                for result in learned:
+                    apply(*result)
+            else:
+                async for rec in aimap.fetch(fetch, spec):
+                    result = learn(rec, train, cache=seen)
+                    if result:
+                        apply(*result)
+    finally:
+        cache.close()
+
+    if to_forward:
+        # the filer handles INBOX matches; forwarding now gives immediate feedback
+        with metrics.span("forward_fetch"):
+            async for rec in aimap.fetch(to_forward, "(BODY.PEEK[])"):
+                if rec["data"] is None:
+                    logger.error("Could not fetch UID %s from %s to forward it", int(rec["uid"]), train)
+                    continue
+                for to_addr in forwards:
+                    await smtp.forward(rec["data"], to_addr)
+    if plan:
+        with metrics.span("execute"):
+            await aimap.call(plan.execute, caps, train)
+
+    logger.debug("Expunging %s", train)
+    with metrics.span("expunge"):
+        await aimap.call(lambda imap: imap.expunge())
+    metrics.count("messages_searched", len(uids), folder=train)
+    metrics.count("messages_cached", len(cached), folder=train)
+    metrics.count("messages_trained", trained, folder=train)
+    if uids:
+        logger.info("%s: trained on %d of %d messages (%d from the header cache), %d rules added, %d updated",
+                    account.label(train), trained, len(uids), len(cached), results["added"], results["updated"])
+    return trained
+
+async def train_account(account, aimap, smtp, caps, train_map=TRAIN_MAP):
+    """Learn from every Train/* folder of train_map; returns messages trained."""
+    started = time.time()
+    store = RuleStore(account.rules_db, account.rules_file)
+    try:
+        store.sync()
+        logger.info("Loaded %d existing rules from %s", len(store), store.path)
+        total_trained = 0
+        for train, actions in train_map.items():
+            total_trained += await train_folder(account, aimap, smtp, caps, train, actions, store)
+            # the folder has been emptied, so keep what was learned from it
+            with metrics.span("save_rules"):
+                store.save()
+        metrics.current.finish_run(started, trained=total_trained, rules=len(store))
+        return total_trained
+    finally:
+        store.close()
+
+async def train_all(account):
+    logger.info("Connecting to %s as %s", account.imap_host, account.imap_user)
+    aimap = await account.connect()
+    logger.info("Connected and authenticated")
+    smtp = account.smtp()
+    try:
+        caps = await aimap.call(capabilities)
+        total_trained = await train_account(account, aimap, smtp, caps)
+        with metrics.span("forward_drain"):
+            await smtp.drain()
+        logger.info("Trainer completed: trained %d messages", total_trained)
+        metrics.current.write(METRICS_FILE)
+    finally:
+        await aimap.logout()
+        logger.info("Disconnected from IMAP server")
 
 def main():
     try:
+        logsetup.setup(LOG_FILE)
         logger.info("Starting trainer...")
+        metrics.start("trainer")
         assert IMAP_USER and IMAP_PASS, "Set IMAP_USER/IMAP_PASS"
-        
-        logger.info(f"Connecting to {IMAP_HOST} as {IMAP_USER}")
-        imap = imaplib.IMAP4_SSL(IMAP_HOST)
-        imap.login(IMAP_USER, IMAP_PASS)
-        logger.info("Connected and authenticated")
+        account = Account("", IMAP_HOST, IMAP_USER, IMAP_PASS, SMTP_HOST, SMTP_USER, SMTP_PASS,
+                          SPOOL_DIR, RULES_FILE, RULES_DB, None, HEADER_CACHE)
+        with metrics.profile(PROFILE_FILE):
+            asyncio.run(train_all(account))
 
-        rules = load_rules()
-        total_trained = 0
-        
-        for train, actions in TRAIN_MAP.items():
-            typ, _ = imap.select(f'"{train}"', readonly=False)
-            if typ != "OK":
-                logger.debug(f"Could not select {train} (folder may not exist)")
-                continue
-            
-            typ, data = imap.uid("SEARCH", None, "ALL")
-            uids = data[0].split() if data and data[0] else []
-            logger.info(f"Found {len(uids)} messages in {train}")
-            
-            for uid in uids:
-                try:
-                    raw = imap.uid("FETCH", uid, "(RFC822)")[1][0][1]
-                    msg = email.message_from_bytes(raw)
-                    subj = email.header.decode_header(msg.get("Subject", "Unknown"))[0][0]
-                    if isinstance(subj, bytes):
-                        subj = subj.decode('utf-8', errors='ignore')
-                    frm = msg.get("From", "Unknown")
-                    logger.debug(f"Processing UID {uid.decode() if isinstance(uid, bytes) else uid} from {train}: From={frm[:50]}, Subject={str(subj)[:50]}")
-
-                    # choose best key
-                    header, key = None, None
-                    lid = extract_listid(msg)
-                    if lid:
-                        header, key = "List-Id", lid
-                        logger.debug(f"  Extracted List-Id: {lid}")
-                    else:
-                        lu = extract_listunsub(msg)
-                        if lu:
-                            header, key = "List-Unsubscribe", lu
-                            logger.debug(f"  Extracted List-Unsubscribe: {lu}")
-                        else:
-                            dom = from_domain(msg)
-                            if dom:  # Skip if from_domain returns None (blocked provider)
-                                header, key = "From", dom
-                                logger.debug(f"  Extracted From domain: {dom}")
-                            else:
-                                logger.info(f"  Skipping UID {uid.decode() if isinstance(uid, bytes) else uid}: no extractable domain (blocked provider)")
-                                continue
-
-                    if train == "Train/Travel":
-                        sh = subject_hint(msg)
-                        logger.debug(f"  Travel message - storing domain rule {header}={key}")
-                        # Store the domain rule regardless; add a subject rule if we found a hint
-                        upsert_rule(rules, header, key, actions)
-                        if sh:
-                            logger.debug(f"  Found travel subject hint: {sh}")
-                            upsert_rule(rules, "Subject", sh, actions)
-                    else:
-                        upsert_rule(rules, header, key, actions)
-
-                    # perform actions now & remove from Train/*
-                    logger.info(f"Training on {train}: {header}={key}")
-                    do_actions(imap, uid, actions)
-                    total_trained += 1
-                    
-                except Exception as e:
-                    logger.error(f"Error processing UID {uid.decode() if isinstance(uid, bytes) else uid}: {e}")
-
-            logger.debug(f"Expunging {train}")
-            imap.expunge()
-
-        save_rules(rules)
-        logger.info(f"Trainer completed: trained {total_trained} messages")
-        imap.logout()
-        logger.info("Disconnected from IMAP server")
-        
     except AssertionError as e:
-        logger.error(f"Configuration error: {e}")
+        logger.error("Configuration error: %s", e)
     except Exception as e:
-        logger.exception(f"Trainer error: {e}")
+        logger.exception("Trainer error: %s", e)
 
 if __name__ == "__main__":
     main()
-